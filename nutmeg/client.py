@@ -14,6 +14,8 @@ import logging
 from logging.handlers import RotatingFileHandler
 
 LOGFILE = 'logs/nutmeg.log'
+STOREFILE = 'data/events.db'
+SESSIONFILE = 'data/session.json'
 
 def startLog(file):
 	log_formatter = logging.Formatter('%(asctime)s %(levelname)s %(filename)s:%(funcName)s(%(lineno)d) %(message)s')
@@ -42,7 +44,7 @@ def main(screen):
 	USERNAME = 'testuser'
 	ROOMNAME = '#test4:lrizika.com'
 	app_log.info('Building Controller...')
-	controller = Controller(screen, HOMESERVER, username=USERNAME, password=PASSWORD)
+	controller = Controller(screen, HOMESERVER, username=USERNAME, password=PASSWORD, storePath=STOREFILE, sessionPath=SESSIONFILE)
 	inputController = InputController(controller)
 	controller.stateManager.joinRoom(ROOMNAME)
 
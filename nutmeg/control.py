@@ -1,19 +1,105 @@
 try:
 	from display import DisplayController
 	from errors import MissingEventIdError
+	from utils import getMessagesBefore
+	from message import MessageBuilder, Message, RoomMember, RoomAliases, CanonicalAlias, RoomName, RoomTopic
+	from state import RoomStates
+	from dedup import SeenSet
+	from store import EventStore, SessionStore
+	from sender import SendQueue, OutboundEvent, backoffDelay, retryAfter
+	from engine import Engine
 except ImportError:
 	from .display import DisplayController
 	from .errors import MissingEventIdError
+	from .utils import getMessagesBefore
+	from .message import MessageBuilder, Message, RoomMember, RoomAliases, CanonicalAlias, RoomName, RoomTopic
+	from .state import RoomStates
+	from .dedup import SeenSet
+	from .store import EventStore, SessionStore
+	from .sender import SendQueue, OutboundEvent, backoffDelay, retryAfter
+	from .engine import Engine
+import asyncio
 import curses
+import itertools
+import json
+import queue
+import threading
+import time
 import matrix_client
 import matrix_client.client
+from matrix_client.errors import MatrixRequestError
 
 import logging
 control_logger = logging.getLogger('root')
 
+class Client(matrix_client.client.MatrixClient):
+	"""
+	MatrixClient which calls a handler with each Room as it's created, before any of the room's events are processed,
+		so listeners can be added in time for the room's first sync.
+		Each room only gets one Room: MatrixClient would replace it whenever it's made again
+		(e.g. by join_room, after a sync already made it), dropping its listeners.
+
+	Attributes:
+		roomHandler (callable or None): Called with each new matrix_client.room.Room. May be called from any thread.
+	"""
+
+	def __init__(self, *args, **kwargs):
+		self.roomHandler = None
+		self.roomsLock = threading.Lock()
+		super().__init__(*args, **kwargs)
+
+	def _mkroom(self, room_id:str) -> matrix_client.room.Room:
+		# Syncs and joins run on different Engine workers, so may make the same room at once
+		with self.roomsLock:
+			room = self.rooms.get(room_id)
+			if room is not None: return(room)
+			room = super()._mkroom(room_id)
+			if self.roomHandler is not None: self.roomHandler(room)
+		return(room)
+
 class Controller:
-	def __init__(self, screen:"curses.window", homeserver:str, username:str=None, password:str=None):
+	"""
+	Top-level controller, connecting the Matrix client to the display.
+
+	Args:
+		screen (curses.window): Screen to display on
+		homeserver (str): Homeserver to connect to
+		username (str, optional): Defaults to None. Username to log in as. If unset, it's prompted for.
+		password (str, optional): Defaults to None. Password to log in with. If unset, it's prompted for.
+		storePath (str, optional): Defaults to ':memory:'. Path of the EventStore database
+		sessionPath (str, optional): Defaults to None. Path of the SessionStore file.
+			If set, syncing resumes from the session saved there rather than starting with a full initial sync.
+
+	Network I/O runs as tasks on an Engine, so the input loop never waits on it.
+		Syncing is one long-lived task, started once. It only puts events into a bounded queue;
+		the UI thread drains the queue in batches between keystrokes, so everything touching the display runs on the UI thread.
+		If the UI thread falls behind, the full queue makes syncing wait rather than buffering without limit.
+	Syncs use a filter (see buildSyncFilter), so they only bring what Nutmeg shows.
+
+	Class Attributes:
+		saveInterval (float): Minimum time between saves of the session, in seconds
+		syncQueueLimit (int): Maximum number of synced events waiting for the UI thread
+		syncBatchLimit (int): Maximum number of synced events to handle per tick, so input stays responsive
+		syncTimeout (int): How long each sync long-polls the homeserver for, in milliseconds
+		syncTimelineLimit (int): Maximum number of timeline events per room in each sync
+	"""
+
+	saveInterval = 10
+	syncQueueLimit = 1000
+	syncBatchLimit = 200
+	syncTimeout = 30000
+	syncTimelineLimit = 50
+
+	def __init__(self, screen:"curses.window", homeserver:str, username:str=None, password:str=None, storePath:str=':memory:', sessionPath:str=None):
 		self.displayController = DisplayController(screen)
+		self.eventStore = EventStore(storePath)
+		self.sessionStore = SessionStore(sessionPath) if sessionPath is not None else None
+		self.lastSave = 0
+		self.saving = False
+		self.roomDumps = {}
+		# Structure:
+		# {'room_id': (RoomState.version, RoomState.dump())}
+		# The last dump of each room's state, reused by saveSession while the state is unchanged
 
 		self.homeserver = homeserver
 		self.username = username
@@ -21,48 +107,344 @@ class Controller:
 
 		self.displayController.statusDisplay.printConnecting(self.homeserver)
 
-		self.client = matrix_client.client.MatrixClient('https://%(homeServer)s' %
+		self.client = Client('https://%(homeServer)s' %
 			{'homeServer': self.homeserver}, cache_level=matrix_client.client.CACHE.NONE)
+		self.client.roomHandler = self.watchRoom
+
+		session = self.sessionStore.load() if self.sessionStore is not None else None
+		if session is not None and (session.get('homeserver') != self.homeserver or session.get('username') != self.username):
+			session = None
 
 		self.displayController.statusDisplay.printLoggingIn(self.username, self.homeserver)
 		if username is None or password is None: self.promptLogin(username=username)
 		else: 
 			success = False
+			attempts = 0
 			while not success:
 				try:
-					self.client.login_with_password(username=self.username, password=self.password)
+					# The first sync runs on the Engine, once the sync filter is set up
+					self.client.login(username=self.username, password=self.password, sync=False)
 					success = True
 				except Exception as e:
-					control_logger.error('Exception while logging in, retrying...: '+str(e))
-		
+					attempts += 1
+					delay = retryAfter(e)
+					if delay is None: delay = backoffDelay(attempts)
+					control_logger.error('Exception while logging in, retrying in %(delay).1fs...: %(error)s' %
+						{'delay': delay,
+						'error': str(e)})
+					time.sleep(delay)
+		if session is not None: self.restoreSession(session)
+		self.setSyncFilter()
 
+		self.engine = Engine(self.client.api, poolSize=Engine.defaultWorkerCount + SendQueue.defaultWorkerCount)
 		self.eventQueue = EventQueue()
 
-		self.stateManager = StateManager(self.client, self.displayController, self.handleEvent)
+		self.stateManager = StateManager(self.client, self.displayController, self.engine, self.handleEvents, self.eventStore)
+		self.displayController.idleHandler = self.idle
+
+		self.syncEvents = queue.Queue(maxsize=self.syncQueueLimit)
+		# (room, event, timeline) from syncing, waiting to be handled on the UI thread
+		# The Room is kept from when the event was queued, as it may have left client.rooms by the time it's handled
+		# timeline is False for events from a sync's state section, e.g. lazy-loaded members
+		# After each sync's events, (None, sync token, None) marks that everything before it is handled once it's reached
+		self.client.add_listener(self.queueEvent)
+		self.engine.spawn(self.sync())
 
 	def promptLogin(self, username:str=None): raise NotImplementedError
 
-	def handleEvent(self, room:matrix_client.room.Room, event:dict):
-		if self.eventQueue.checkAndSetHandled(event):
-			control_logger.debug('Already handled event %(eventId)s' %
-				{'eventId': event['event_id']})
+	def restoreSession(self, session:dict):
+		"""
+		Restore the sync token and room state saved by saveSession.
+		
+		Args:
+			session (dict): The session, as from SessionStore.load
+		"""
+
+		self.client.sync_token = session['next_batch']
+		for alias, roomId in session.get('aliases', {}).items():
+			RoomStates.addAlias(alias, roomId)
+		for roomId, roomData in session.get('rooms', {}).items():
+			room = self.client.rooms.get(roomId) or self.client._mkroom(roomId)
+			RoomStates.get(room).restore(roomData)
+		control_logger.info('Resumed session with %(count)d rooms from sync token %(token)s' %
+			{'count': len(session.get('rooms', {})),
+			'token': str(session['next_batch'])})
+
+	def buildSyncFilter(self) -> dict:
+		"""
+		Build the filter syncs use.
+			Members are lazy-loaded, so syncs only bring the members of the senders of the events they bring.
+			Each room's timeline is capped at syncTimelineLimit events; older ones are backfilled as needed.
+			Only event types some Message class handles are kept, and presence, ephemeral events
+			(typing notifications, receipts) and account data are dropped, as Nutmeg doesn't show them.
+		
+		Returns:
+			dict: The filter, as a Matrix filter definition
+		"""
+
+		eventTypes = MessageBuilder.eventTypes()
+		return({
+			'presence': {'not_types': ['*']},
+			'account_data': {'not_types': ['*']},
+			'room': {
+				'timeline': {
+					'limit': self.syncTimelineLimit,
+					'types': eventTypes,
+					'lazy_load_members': True
+				},
+				'state': {
+					'types': eventTypes,
+					'lazy_load_members': True
+				},
+				'ephemeral': {'not_types': ['*']},
+				'account_data': {'not_types': ['*']}
+			}
+		})
+
+	def setSyncFilter(self):
+		"""
+		Upload the sync filter, and have the client sync with it.
+			If the upload fails, the filter is sent inline with each sync instead.
+		"""
+
+		syncFilter = self.buildSyncFilter()
+		try:
+			self.client.sync_filter = self.client.api.create_filter(self.client.user_id, syncFilter)['filter_id']
+		except Exception as e:
+			control_logger.error('Exception while uploading sync filter, sending it inline instead: %(error)s' %
+				{'error': str(e)})
+			self.client.sync_filter = json.dumps(syncFilter)
+
+	def watchRoom(self, room:matrix_client.room.Room):
+		"""
+		Listen for events in a room's state, as well as its timeline.
+			Called once for each room as the client creates it, so the listener is in place before the room's first sync.
+			With lazy-loaded members, a sync's state holds the members who sent its timeline's events.
+			A room's first sync also brings the rest of the state we keep, e.g. its name, topic and aliases.
+		
+		Args:
+			room (matrix_client.room.Room): The room
+		"""
+
+		room.add_state_listener(lambda event: self.queueStateEvent(room, event))
+
+	def saveSession(self, syncToken:str, force:bool = False):
+		"""
+		Save a sync token and the room state, so the next run can resume from them. Must be called from the UI thread.
+			Only rooms whose state changed since the last save are dumped again,
+			and the session is written to disk as an Engine task, so saving doesn't hold up input.
+			If the last save is still being written, this one is skipped.
+		
+		Args:
+			syncToken (str): Sync token to resume from. Every event synced before it must have been handled.
+			force (bool, optional): Defaults to False. If set, save even if the last save was less than saveInterval ago.
+		"""
+
+		if self.sessionStore is None or syncToken is None or self.saving: return
+		now = time.monotonic()
+		if not force and now - self.lastSave < self.saveInterval: return
+		self.lastSave = now
+
+		rooms = {}
+		for roomId, room in list(self.client.rooms.items()):
+			roomState = RoomStates.get(room)
+			version, dump = self.roomDumps.get(roomId, (None, None))
+			if version != roomState.version:
+				version, dump = roomState.version, roomState.dump()
+				self.roomDumps[roomId] = (version, dump)
+			rooms[roomId] = dump
+		self.saving = True
+		self.engine.run(self.sessionStore.save, {
+			'homeserver': self.homeserver,
+			'username': self.username,
+			'next_batch': syncToken,
+			'rooms': rooms,
+			'aliases': dict(RoomStates.aliasIndex)
+		}, callback=self.receiveSave)
+
+	def receiveSave(self, result, error:Exception):
+		"""
+		Called on the UI thread once writing the session finishes.
+		
+		Args:
+			result: Unused
+			error (Exception): The error writing the session, or None
+		"""
+
+		self.saving = False
+		if error is not None:
+			control_logger.error('Exception while saving session: %(error)s' %
+				{'error': str(error)})
+
+	async def sync(self):
+		"""
+		Sync with the homeserver for as long as the client runs, long-polling for syncTimeout at a time.
+			Failed syncs are retried with exponential backoff, or after as long as a rate limit asks.
+			Each sync's events are followed in syncEvents by its sync token,
+			as the client takes the new token before it hands out the events.
+		"""
+
+		failures = 0
+		while True:
+			try:
+				await self.engine.call(self.client._sync, self.syncTimeout)
+				failures = 0
+				await self.engine.call(self.syncEvents.put, (None, self.client.sync_token, None))
+			except Exception as e:
+				failures += 1
+				delay = retryAfter(e)
+				if delay is None: delay = backoffDelay(failures)
+				control_logger.error('Exception while syncing, retrying in %(delay).1fs...: %(error)s' %
+					{'delay': delay,
+					'error': str(e)})
+				await asyncio.sleep(delay)
+
+	def queueEvent(self, event:dict):
+		"""
+		Global listener for synced events. Runs on an Engine worker, so only queues the event for the UI thread.
+			Blocks while the queue is full.
+		
+		Args:
+			event (dict): The event, with its room_id
+		"""
+
+		room = self.client.rooms.get(event['room_id'])
+		if room is None: return # Already left
+		self.syncEvents.put((room, event, True))
+
+	def queueStateEvent(self, room:matrix_client.room.Room, event:dict):
+		"""
+		State listener for synced state events, as with queueEvent.
+		
+		Args:
+			room (matrix_client.room.Room): Room the event is from
+			event (dict): The event
+		"""
+
+		self.syncEvents.put((room, event, False))
+
+	def receiveEvents(self):
+		"""
+		Handle a batch of the events syncing has queued, grouped by room. Must be called from the UI thread.
+		"""
+
+		batch = {}
+		# Structure:
+		# {'room_id': (room, [event, ...])}
+		for _ in range(self.syncBatchLimit):
+			try:
+				room, event, timeline = self.syncEvents.get_nowait()
+			except queue.Empty:
+				break
+			if room is None:
+				# Every event from before this sync token is handled once the batch so far is, so it's safe to save
+				self._handleTimelines(batch)
+				batch = {}
+				self.saveSession(event)
+			elif timeline:
+				batch.setdefault(room.room_id, (room, []))[1].append(event)
+			else:
+				# A state section is current state (e.g. filling a limited sync's gap), so it's kept but not shown.
+				# It's applied in order with the timelines around it, so earlier timelines can't overwrite it.
+				self._handleTimelines(batch)
+				batch = {}
+				self.ingestState(room, event, current=True)
+		self._handleTimelines(batch)
+
+	def _handleTimelines(self, batch:dict):
+		# Handle synced timeline events, as {'room_id': (room, [event, ...])}
+		for room, events in batch.values():
+			self.handleEvents(room, events, current=True)
+
+	def idle(self):
+		"""
+		Called while input is idle. Handles synced events and finished Engine tasks, then the StateManager's idle work.
+		"""
+
+		self.receiveEvents()
+		self.engine.receive()
+		self.stateManager.idle()
+
+	def handleEvents(self, room:matrix_client.room.Room, events:list, persist:bool = True, current:bool = False):
+		"""
+		Handle a chunk of events (e.g. a backfill, or a batch from sync) at once.
+			Events which were already handled are dropped, and the rest are stored and queued together.
+		
+		Args:
+			room (matrix_client.room.Room): Room the events are from
+			events (list): Events to handle, ordered old to new
+			persist (bool, optional): Defaults to True. Whether to store the events. Unset for events loaded from the store.
+			current (bool, optional): Defaults to False. Whether the events are new from sync, rather than from history
+		"""
+
+		newEvents = [event for event in events if not self.eventQueue.checkAndSetHandled(event)]
+		control_logger.debug('Handling %(new)d new events of %(total)d in room %(roomId)s' %
+			{'new': len(newEvents),
+			'total': len(events),
+			'roomId': room.room_id})
+		if persist: self.eventStore.addEvents(room.room_id, newEvents)
+		for event in newEvents:
+			self.ingestState(room, event, current=current)
+		if newEvents:
+			self.displayController.enqueueMany(newEvents, room)
+
+	def ingestState(self, room:matrix_client.room.Room, event:dict, current:bool = True):
+		"""
+		Update the locally kept state of a room from an event, if it's a state event we keep.
+		
+		Args:
+			room (matrix_client.room.Room): Room the event is from
+			event (dict): The event
+			current (bool, optional): Defaults to True. Whether the event is new, rather than from history (e.g. a backfill)
+		"""
+
+		messageType = MessageBuilder.selectMessageType(event)
+		if issubclass(messageType, RoomMember):
+			RoomStates.get(room).updateMember(event, current=current)
+			# Messages already drawn may show the member's old name
+			if room is self.stateManager.currentRoom:
+				self.displayController.redrawMessages()
 			return
+		elif issubclass(messageType, RoomAliases):
+			RoomStates.get(room).updateAliases(event, current=current)
+		elif issubclass(messageType, CanonicalAlias):
+			RoomStates.get(room).updateCanonicalAlias(event, current=current)
+		elif issubclass(messageType, RoomName):
+			RoomStates.get(room).updateName(event, current=current)
+		elif issubclass(messageType, RoomTopic):
+			RoomStates.get(room).updateTopic(event, current=current)
 		else:
-			control_logger.debug('Handling event %(eventId)s' %
-				{'eventId': event['event_id']})
-			self.displayController.enqueue(event, room)
+			return
+		# The room header shows the room's name (or an alias) and topic
+		if room is self.stateManager.currentRoom:
+			self.displayController.statusDisplay.printRoomHeader(room)
 
 	def sendMessage(self, text:str):
 		self.stateManager.sendMessage(text)
 		# TODO
 
 	def printResult(self, output:dict):
+		if self.stateManager.currentRoom is None:
+			# Still joining the first room, so there's nowhere to show it
+			self.displayController.statusDisplay.printNotInRoom()
+			return
 		self.displayController.enqueue(output, self.stateManager.currentRoom)
 
 
 class EventQueue:
-	def __init__(self):
-		self.handled = {}
+	"""
+	Tracks which events have been handled, by event ID.
+		Only event IDs are kept, in a SeenSet, so memory stays bounded however long the client runs.
+		Recently handled IDs are checked exactly; older ones may very rarely be mistaken for handled.
+
+	Args:
+		falsePositiveRate (float, optional): Defaults to SeenSet.defaultFalsePositiveRate.
+			Maximum probability that an unhandled event is reported as handled
+		recentLimit (int, optional): Defaults to SeenSet.defaultRecentLimit. Number of recent event IDs to check exactly
+	"""
+
+	def __init__(self, falsePositiveRate:float = None, recentLimit:int = None):
+		self.handled = SeenSet(recentLimit=recentLimit, falsePositiveRate=falsePositiveRate)
 
 	def checkAndSetHandled(self, event:dict) -> bool:
 		"""
@@ -92,25 +474,76 @@ class EventQueue:
 			return(False)
 
 	def setHandled(self, event:dict):
-		self.handled[event['event_id']] = event
+		self.handled.add(event['event_id'])
 
 class StateManager:
-	def __init__(self, client:matrix_client.client.MatrixClient, displayController:DisplayController, eventHandler:callable):
+	"""
+	Manages the rooms the client is in, and which is current.
+
+	History is loaded a screenful at a time when a room is first opened, and a page at a time as it's scrolled back through.
+		Pages come from the EventStore while it has older events, then from the homeserver.
+		They're fetched ahead of scrolling as Engine tasks while input is idle, and handed back to the UI thread
+		when they finish, so scrolling back never waits on the homeserver. Several rooms can load history at once.
+		Joining rooms and loading their members run as Engine tasks too.
+
+	Class Attributes:
+		catchUpLimit (int): Maximum number of events to fetch from the homeserver when a room is first opened,
+			catching up to the newest stored event
+		pageSize (int): Number of events to load per page of history
+		maxEmptyPages (int): Maximum number of pages of already stored events to skip per backfill
+	"""
+
+	catchUpLimit = 500
+	pageSize = 100
+	maxEmptyPages = 10
+
+	def __init__(self, client:matrix_client.client.MatrixClient, displayController:DisplayController, engine:Engine, eventsHandler:callable, eventStore:EventStore):
 		self.client = client
 		self.displayController = displayController
-		self.eventHandler = eventHandler
+		self.engine = engine
+		self.eventsHandler = eventsHandler
+		self.eventStore = eventStore
 		self.currentRoom = None
 		self.rooms = {}
+		self.historyLoaded = set()
+		self.historyTokens = {}
+		# Structure:
+		# {'room_id': token}
+		# Pagination token to fetch each room's next page of history from the homeserver with
+		self.historyStarts = set()
+		# Rooms whose history has been fetched back to the start
+		self.historyGaps = set()
+		# Rooms with a gap between the history fetched from the homeserver and the stored history,
+		# so history is fetched from the homeserver until it's filled
+		self.historyExhausted = set()
+		# Rooms whose whole history is loaded
+
+		self.prefetching = set()
+		# Rooms with history being fetched
+		self.historyFailures = {}
+		# Structure:
+		# {'room_id': (failures, retryTime)}
+		# Rooms whose last history fetches failed, and the time.monotonic() before which not to try again
+		self.loadingMembers = set()
+		# Rooms with members being fetched
+		self.headersFetched = set()
+		# Rooms whose name and topic have been fetched, as none were known when they were opened
+		self.displayController.historyHandler = self.requestHistory
+
+		self.startTs = int(time.time() * 1000)
+		self.transactionIds = itertools.count()
+		# Transaction IDs are unique per access token, so they include when this run started
+		self.sendStatuses = queue.Queue()
+		# OutboundEvents whose status has changed, from the send queue's workers
+		self.sendQueue = SendQueue(self.client.api, self.sendStatuses.put)
 
 	def joinRoom(self, roomId:str):
 		self.displayController.statusDisplay.printJoining(roomId)
 		control_logger.info('Current rooms: '+str(self.rooms))
 		control_logger.info('Checking to see if room is known: '+roomId)
-		for knownRoom in self.rooms:
-			# Check if we're joining an alias of an already-known room
-			self.rooms[knownRoom].update_aliases()
-			if roomId in self.rooms[knownRoom].aliases:
-				roomId = knownRoom
+		# Check if we're joining an alias of an already-known room
+		requested = roomId
+		roomId = RoomStates.resolveAlias(requested) or roomId
 		if roomId in self.rooms: 
 			control_logger.info('Joining known room: '+roomId)
 			room = self.rooms[roomId]
@@ -119,34 +552,357 @@ class StateManager:
 			room = self.client.rooms[roomId]
 		else:
 			control_logger.info('Joining new room: '+roomId)
-			room = self.client.join_room(roomId)
-			self.rooms[roomId] = room
-			
-			room.add_listener(self.eventHandler)
-			self.client.stop_listener_thread()
-			self.client.start_listener_thread()
-			room.backfill_previous_messages(limit=500) # TODO
-			#except Exception as e:
-			#	control_logger.error('Exception while joining room: '+str(e))
-			#	self.eventManager.displayManager.statusDisplay.printStatus('Failed to join room: '+roomId)
-			#	room = self.currentRoom
-			#	return
+			# The room is opened once it's joined. Syncing picks it up from its next sync.
+			self.engine.run(self.client.join_room, requested,
+				callback=lambda room, error: self.receiveJoin(requested, room, error))
+			return
+		self.openRoom(room)
+
+	def receiveJoin(self, roomId:str, room:matrix_client.room.Room, error:Exception):
+		"""
+		Open a newly joined room. Called on the UI thread once joining it finishes.
+		
+		Args:
+			roomId (str): ID or alias the room was joined by
+			room (matrix_client.room.Room): The joined room, or None if joining failed
+			error (Exception): The error joining it, or None
+		"""
+
+		if error is not None:
+			control_logger.error('Exception while joining room %(roomId)s: %(error)s' %
+				{'roomId': roomId,
+				'error': str(error)})
+			self.displayController.statusDisplay.printStatus('Failed to join room: '+roomId)
+			return
+		self.rooms[room.room_id] = room
+		if roomId != room.room_id:
+			# Joined by alias, so joining it again is a local lookup
+			RoomStates.addAlias(roomId, room.room_id)
+		self.openRoom(room)
+
+	def openRoom(self, room:matrix_client.room.Room):
+		"""
+		Make a room current, showing its stored history straight away,
+			and starting Engine tasks to catch up on its history, and load its members, name and topic if needed.
+		
+		Args:
+			room (matrix_client.room.Room): The room
+		"""
+
+		loadHistory = room.room_id not in self.historyLoaded
+		if loadHistory:
+			# Show what we have on disk straight away, then catch up from the homeserver
+			self.historyLoaded.add(room.room_id)
+			stored = self.eventStore.getEvents(room.room_id, limit=self.screenful)
+			self.eventsHandler(room, stored, persist=False)
 		self.currentRoom = room
-		self.displayController.changeRoom(room)#, sortFirst=True)
+		self.displayController.changeRoom(room)
 		self.displayController.statusDisplay.printRoomHeader(room)
+
+		if loadHistory:
+			# Without stored history to catch up to, one screenful is enough.
+			# Backfill waits for the catch-up, as both page back from the newest event.
+			self.prefetching.add(room.room_id)
+			self.engine.run(self.fetchHistory, room, limit=self.catchUpLimit if stored else self.screenful,
+				callback=lambda events, error: self.receiveCatchUp(room, events, error))
+		if not RoomStates.get(room).membersLoaded and room.room_id not in self.loadingMembers:
+			self.loadingMembers.add(room.room_id)
+			self.engine.run(room.get_joined_members,
+				callback=lambda members, error: self.receiveMembers(room, members, error))
+		roomState = RoomStates.get(room)
+		if roomState.name is None and roomState.topic is None and room.room_id not in self.headersFetched:
+			# Usually they arrive with the room's state from sync, but fetch them once in case they haven't
+			self.headersFetched.add(room.room_id)
+			self.engine.run(self.fetchHeader, room,
+				callback=lambda header, error: self.receiveHeader(room, header, error))
 		#self.eventManager.displayManager.changeRoom(room)
 		#self.eventManager.displayManager.messageDisplay.printQueue(room, sortFirst=True)
 
+	def fetchHeader(self, room:matrix_client.room.Room) -> tuple:
+		"""
+		Fetch a room's name and topic from the homeserver.
+			This blocks on the homeserver, so is run as an Engine task.
+		
+		Args:
+			room (matrix_client.room.Room): The room
+		
+		Returns:
+			tuple: (name, topic). Either is None if the room has none.
+		"""
+
+		header = []
+		for fetch, key in ((self.client.api.get_room_name, 'name'), (self.client.api.get_room_topic, 'topic')):
+			try:
+				header.append(fetch(room.room_id).get(key) or None)
+			except MatrixRequestError as e:
+				if e.code != 404: raise
+				header.append(None) # The room has no such state
+		return(tuple(header))
+
+	def receiveHeader(self, room:matrix_client.room.Room, header:tuple, error:Exception):
+		"""
+		Fill in a room's name and topic, where no state event has given them since they were fetched.
+			Called on the UI thread once fetchHeader finishes.
+		
+		Args:
+			room (matrix_client.room.Room): The room
+			header (tuple): (name, topic), as from fetchHeader, or None if fetching them failed
+			error (Exception): The error fetching them, or None
+		"""
+
+		if error is not None:
+			control_logger.error('Exception while fetching the name and topic of room %(roomId)s: %(error)s' %
+				{'roomId': room.room_id,
+				'error': str(error)})
+			return
+		name, topic = header
+		roomState = RoomStates.get(room)
+		if roomState.name is None: roomState.name = name
+		if roomState.topic is None: roomState.topic = topic
+		if room is self.currentRoom:
+			self.displayController.statusDisplay.printRoomHeader(room)
+
+	def receiveCatchUp(self, room:matrix_client.room.Room, events:list, error:Exception):
+		"""
+		Queue a room's recent history. Called on the UI thread once fetchHistory finishes.
+		
+		Args:
+			room (matrix_client.room.Room): The room
+			events (list): Events fetched, as from fetchHistory, or None if fetching them failed
+			error (Exception): The error fetching them, or None
+		"""
+
+		self.prefetching.discard(room.room_id)
+		if error is not None:
+			control_logger.error('Exception while catching up on room %(roomId)s: %(error)s' %
+				{'roomId': room.room_id,
+				'error': str(error)})
+			return
+		self.eventsHandler(room, events)
+
+	def receiveMembers(self, room:matrix_client.room.Room, members:list, error:Exception):
+		"""
+		Fill a room's member index. Called on the UI thread once fetching its members finishes.
+		
+		Args:
+			room (matrix_client.room.Room): The room
+			members (list): Its joined members, or None if fetching them failed
+			error (Exception): The error fetching them, or None
+		"""
+
+		self.loadingMembers.discard(room.room_id)
+		if error is not None:
+			control_logger.error('Exception while loading members of room %(roomId)s: %(error)s' %
+				{'roomId': room.room_id,
+				'error': str(error)})
+			return
+		RoomStates.get(room).setJoinedMembers(members)
+		if room is self.currentRoom:
+			self.displayController.statusDisplay.printRoomHeader(room)
+			# Messages drawn before the members were known show user IDs rather than names
+			self.displayController.redrawMessages()
+
+	def fetchHistory(self, room:matrix_client.room.Room, limit:int) -> list:
+		"""
+		Fetch a room's recent history from the homeserver, back to the newest event already stored.
+			Where to fetch the next page of history from is kept for backfill.
+			If the limit is reached before the stored events are, the room is marked as having a gap.
+			This blocks on the homeserver, so is run as an Engine task.
+		
+		Args:
+			room (matrix_client.room.Room): Room to fetch history for
+			limit (int): Maximum number of events to fetch
+		
+		Returns:
+			list: Events which aren't stored yet, ordered old to new
+		"""
+
+		events = []
+		token = room.prev_batch # None fetches from the newest event
+		reachedStored = False
+		while len(events) < limit:
+			chunk, token = getMessagesBefore(room, token, limit=min(self.pageSize, limit - len(events)))
+			known = self.eventStore.knownEventIds(event['event_id'] for event in chunk)
+			newestKnown = max((i for i, event in enumerate(chunk) if event['event_id'] in known), default=-1)
+			events[0:0] = chunk[newestKnown+1:]
+			reachedStored = newestKnown >= 0
+			if reachedStored or token is None: break # Reached what we already have, or the start of the room
+
+		self.historyTokens[room.room_id] = token
+		if token is None: self.historyStarts.add(room.room_id)
+		if events and token is not None and not reachedStored:
+			if self.eventStore.getEvents(room.room_id, limit=1, before=int(events[0]['origin_server_ts'])):
+				self.historyGaps.add(room.room_id)
+		control_logger.info('Fetched %(count)d events of history for room %(roomId)s' %
+			{'count': len(events),
+			'roomId': room.room_id})
+		return(events)
+
+	@property
+	def screenful(self) -> int:
+		"""
+		Number of events which can fill the message display, as each takes at least one row.
+		"""
+		return(self.displayController.pageHeight + 1)
+
+	def requestHistory(self, room:matrix_client.room.Room):
+		"""
+		Start fetching a page of history older than the oldest loaded event in a room, without waiting for it.
+			The page is queued once it arrives, when the UI thread next receives finished Engine tasks.
+			Does nothing if history is already on its way, or the room's whole history is loaded,
+			or while backing off after the last fetch failed.
+		
+		Args:
+			room (matrix_client.room.Room): Room to load history for
+		"""
+
+		if room.room_id in self.prefetching or room.room_id in self.historyExhausted: return
+		if time.monotonic() < self.historyFailures.get(room.room_id, (0, 0))[1]: return
+		oldest = self.displayController.messageDisplay.messageQueues.getOldest(room)
+		before = int(oldest['origin_server_ts']) if oldest is not None else None
+		self.prefetching.add(room.room_id)
+		self.engine.run(self.fetchPage, room, before,
+			callback=lambda page, error: self.receivePage(room, page, error))
+
+	def receivePage(self, room:matrix_client.room.Room, page:tuple, error:Exception):
+		"""
+		Queue a page of history. Called on the UI thread once fetching it finishes.
+		
+		Args:
+			room (matrix_client.room.Room): Room the page is from
+			page (tuple): (events, persist), as from fetchPage, or None if fetching it failed
+			error (Exception): The error fetching it, or None
+		"""
+
+		self.prefetching.discard(room.room_id)
+		if error is not None:
+			# Back off, or wait as long as a rate limit asks, so idle ticks don't retry straight away
+			failures = self.historyFailures.get(room.room_id, (0, 0))[0] + 1
+			delay = retryAfter(error)
+			if delay is None: delay = backoffDelay(failures)
+			self.historyFailures[room.room_id] = (failures, time.monotonic() + delay)
+			control_logger.error('Exception while fetching history for room %(roomId)s, retrying in %(delay).1fs: %(error)s' %
+				{'roomId': room.room_id,
+				'delay': delay,
+				'error': str(error)})
+			return
+		self.historyFailures.pop(room.room_id, None)
+		events, persist = page
+		if events:
+			self.eventsHandler(room, events, persist=persist)
+		elif room.room_id in self.historyStarts:
+			self.historyExhausted.add(room.room_id)
+
+	def idle(self):
+		"""
+		Called by the Controller while input is idle. Shows send statuses,
+			and prefetches history if the view is near the oldest loaded message.
+		"""
+
+		self.receiveSendStatuses()
+		if self.displayController.nearOldest:
+			self.requestHistory(self.currentRoom)
+
+	def fetchPage(self, room:matrix_client.room.Room, before:int = None) -> tuple:
+		"""
+		Fetch a page of history from before a time.
+			Stored events are used first. Once there are none older, pages are fetched from the homeserver,
+			skipping up to maxEmptyPages pages of events which are already stored.
+			This blocks on the homeserver, so is run as an Engine task.
+		
+		Args:
+			room (matrix_client.room.Room): Room to fetch history for
+			before (int, optional): Defaults to None. origin_server_ts of the oldest loaded event
+		
+		Returns:
+			tuple: (events, persist). The events, ordered old to new, and whether they need storing
+		"""
+
+		if room.room_id not in self.historyGaps:
+			stored = self.eventStore.getEvents(room.room_id, limit=self.pageSize, before=before)
+			if stored: return((stored, False))
+
+		if room.room_id in self.historyStarts: return(([], False))
+		events = []
+		token = self.historyTokens.get(room.room_id, room.prev_batch)
+		for _ in range(self.maxEmptyPages):
+			chunk, token = getMessagesBefore(room, token, limit=self.pageSize)
+			known = self.eventStore.knownEventIds(event['event_id'] for event in chunk)
+			events[0:0] = chunk
+			if known:
+				# Reached the stored history, so the next page can come from the store again
+				self.historyGaps.discard(room.room_id)
+			if token is None:
+				self.historyStarts.add(room.room_id)
+				break
+			if len(known) < len(chunk): break
+		self.historyTokens[room.room_id] = token
+		control_logger.info('Fetched %(count)d events of history for room %(roomId)s' %
+			{'count': len(events),
+			'roomId': room.room_id})
+		return((events, True))
+
 	def sendMessage(self, text:str):
-		self.currentRoom.send_text(text)
-		self.currentRoom.backfill_previous_messages(limit=5) # TODO: Replace this with something that doesn't get confused by _prev_batch
+		self.send(self.currentRoom, {'msgtype': 'm.text', 'body': text})
 
 	def sendEmote(self, text:str):
-		self.currentRoom.send_emote(text)
-		self.currentRoom.backfill_previous_messages(limit=5) # TODO: Replace this with something that doesn't get confused by _prev_batch
+		self.send(self.currentRoom, {'msgtype': 'm.emote', 'body': text})
+
+	def send(self, room:matrix_client.room.Room, content:dict, eventType:str = 'm.room.message'):
+		"""
+		Queue an event to be sent to a room, showing it straight away as a local echo.
+			The echo is keyed by its transaction ID, and replaced when the homeserver's copy of the event arrives through sync.
+			Until then it shows its send status, as updated by receiveSendStatuses.
+		
+		Args:
+			room (matrix_client.room.Room): Room to send to
+			content (dict): Content of the event
+			eventType (str, optional): Defaults to 'm.room.message'. Type of the event
+		"""
+
+		if room is None:
+			# Still joining the first room
+			self.displayController.statusDisplay.printNotInRoom()
+			return
+		transactionId = 'nutmeg%(start)d.%(n)d' % {'start': self.startTs, 'n': next(self.transactionIds)}
+		echo = {
+			'type': eventType,
+			'content': content,
+			'event_id': 'local:' + transactionId,
+			'sender': self.client.user_id,
+			'origin_server_ts': int(time.time() * 1000),
+			'unsigned': {
+				'transaction_id': transactionId,
+				Message.sendStatusKey: OutboundEvent.QUEUED
+			}
+		}
+		self.displayController.echo(echo, room)
+		self.sendQueue.put(room, eventType, content, transactionId)
+
+	def receiveSendStatuses(self):
+		"""
+		Show the send statuses the send queue has reported on their local echoes. Must be called from the UI thread.
+		"""
+
+		while True:
+			try:
+				outbound = self.sendStatuses.get_nowait()
+			except queue.Empty:
+				return
+			if outbound.status == OutboundEvent.SENT:
+				self.displayController.messageDisplay.messageQueues.confirmEcho(outbound.room, outbound.transactionId, outbound.eventId)
+				self.displayController.setEchoStatus(outbound.room, outbound.transactionId, None)
+			else:
+				self.displayController.setEchoStatus(outbound.room, outbound.transactionId, outbound.status)
+				if outbound.status == OutboundEvent.FAILED:
+					self.displayController.statusDisplay.printStatus('Failed to send message: '+str(outbound.error))
 
 	def pageUp(self):
-		self.displayController.changeOffset(10)
+		self.engine.receive()
+		if self.currentRoom is not None and self.currentRoom.room_id in self.historyGaps:
+			# The gap is above the newest messages rather than at the top, so fill it whenever scrolling back
+			self.requestHistory(self.currentRoom)
+		self.displayController.changeOffset(self.displayController.pageHeight)
 
 	def pageDown(self):
-		self.displayController.changeOffset(-10)
+		self.displayController.changeOffset(-self.displayController.pageHeight)
@@ -0,0 +1,127 @@
+"""
+Compact set membership, for remembering which events have been seen without keeping them.
+"""
+
+import collections
+import hashlib
+import math
+
+class BloomFilter:
+	"""
+	Bloom filter of strings.
+		Never reports an added string as missing, but may report a string which wasn't added as present,
+		with probability falsePositiveRate while no more than capacity strings have been added.
+
+	Args:
+		capacity (int): Number of strings the filter is sized for
+		falsePositiveRate (float): Probability of a false positive once capacity strings have been added
+
+	Attributes:
+		capacity (int): Number of strings the filter is sized for
+		size (int): Number of bits in the filter
+		hashCount (int): Number of bits set per string
+		count (int): Number of strings added
+	"""
+
+	def __init__(self, capacity:int, falsePositiveRate:float):
+		self.capacity = capacity
+		self.size = max(8, int(math.ceil(-capacity * math.log(falsePositiveRate) / math.log(2) ** 2)))
+		self.hashCount = max(1, int(round(self.size / capacity * math.log(2))))
+		self.bits = bytearray((self.size + 7) // 8)
+		self.count = 0
+
+	def _positions(self, item:str):
+		digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+		h1 = int.from_bytes(digest[:8], 'little')
+		h2 = int.from_bytes(digest[8:], 'little') | 1
+		for i in range(self.hashCount):
+			yield((h1 + i * h2) % self.size)
+
+	def add(self, item:str):
+		"""
+		Add a string to the filter.
+
+		Args:
+			item (str): String to add
+		"""
+
+		for position in self._positions(item):
+			self.bits[position >> 3] |= 1 << (position & 7)
+		self.count += 1
+
+	def __contains__(self, item:str) -> bool:
+		return(all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item)))
+
+	def full(self) -> bool:
+		"""
+		Check whether the filter holds as many strings as it's sized for.
+
+		Returns:
+			bool: Whether capacity strings have been added
+		"""
+
+		return(self.count >= self.capacity)
+
+class SeenSet:
+	"""
+	Set of strings seen, with bounded memory.
+		The most recent recentLimit strings are kept exactly. Older strings are moved into Bloom filters,
+		each holding filterCapacity strings. filterCount full filters are kept, as well as the one being filled;
+		once that one fills, the oldest filter is dropped.
+		So membership is exact for recent strings, has at most falsePositiveRate false positives for older ones,
+		and at least the last recentLimit + filterCount * filterCapacity strings are remembered.
+
+	Args:
+		recentLimit (int, optional): Defaults to SeenSet.defaultRecentLimit. Number of recent strings to keep exactly
+		filterCapacity (int, optional): Defaults to SeenSet.defaultFilterCapacity. Number of strings per Bloom filter
+		filterCount (int, optional): Defaults to SeenSet.defaultFilterCount. Number of full Bloom filters to keep
+		falsePositiveRate (float, optional): Defaults to SeenSet.defaultFalsePositiveRate.
+			Maximum probability that a string which wasn't seen is reported as seen
+
+	Class Attributes:
+		defaultRecentLimit (int): Default number of recent strings to keep exactly
+		defaultFilterCapacity (int): Default number of strings per Bloom filter
+		defaultFilterCount (int): Default number of full Bloom filters to keep
+		defaultFalsePositiveRate (float): Default maximum false positive probability
+	"""
+
+	defaultRecentLimit = 10000
+	defaultFilterCapacity = 100000
+	defaultFilterCount = 4
+	defaultFalsePositiveRate = 1e-6
+
+	def __init__(self, recentLimit:int = None, filterCapacity:int = None, filterCount:int = None, falsePositiveRate:float = None):
+		if recentLimit is None: recentLimit = self.defaultRecentLimit
+		if filterCapacity is None: filterCapacity = self.defaultFilterCapacity
+		if filterCount is None: filterCount = self.defaultFilterCount
+		if falsePositiveRate is None: falsePositiveRate = self.defaultFalsePositiveRate
+		self.recentLimit = recentLimit
+		self.filterCapacity = filterCapacity
+		self.filterCount = filterCount
+		# A string is checked against every filter, including the one being filled, so their rates add up
+		self.filterRate = falsePositiveRate / (filterCount + 1)
+		self.recent = collections.OrderedDict()
+		# Oldest first
+		self.filters = collections.deque()
+		# Oldest first; new strings are added to the last
+
+	def add(self, item:str):
+		"""
+		Add a string to the set, moving the oldest recent strings into the Bloom filters if needed.
+
+		Args:
+			item (str): String to add
+		"""
+
+		self.recent[item] = None
+		self.recent.move_to_end(item)
+		while len(self.recent) > self.recentLimit:
+			old, _ = self.recent.popitem(last=False)
+			if not self.filters or self.filters[-1].full():
+				self.filters.append(BloomFilter(self.filterCapacity, self.filterRate))
+			self.filters[-1].add(old)
+			if self.filters[-1].full() and len(self.filters) > self.filterCount: self.filters.popleft()
+
+	def __contains__(self, item:str) -> bool:
+		if item in self.recent: return(True)
+		return(any(item in bloomFilter for bloomFilter in self.filters))
@@ -1,114 +1,614 @@
 try:
-	from .utils import tsToDt, getMember, descendants, getLastChar2
+	from .utils import tsToDt, descendants, redactedEvent
 	from .constants import MTYPE, MODES
 	from .message import MessageBuilder, Message, RoomRedaction, RedactedEvent
 	from .errors import InvalidModeError
+	from .layout import HeightIndex
+	from .state import RoomStates
+	from .timeline import Timeline
 except ImportError:
-	from utils import tsToDt, getMember, descendants, getLastChar2
+	from utils import tsToDt, descendants, redactedEvent
 	from constants import MTYPE, MODES
 	from message import MessageBuilder, Message, RoomRedaction, RedactedEvent
 	from errors import InvalidModeError
+	from layout import HeightIndex
+	from state import RoomStates
+	from timeline import Timeline
 import curses, _curses
+import collections
+import threading
+import time
 import matrix_client.room
 
 import logging
 display_logger = logging.getLogger('root')
 
+class QueuedEvent:
+	"""
+	Compact record of an event in a MessageQueue.
+		The Message for the event is only built when it's needed for display, and may be evicted again.
+	
+	Args:
+		event (dict): Event to queue
+
+	Attributes:
+		event (dict): The queued event
+		message (Message or None): The Message built from the event, if it's currently materialized
+		heights (dict or None): Measured heights of the Message, keyed by width. Kept when the Message is evicted.
+	"""
+
+	__slots__ = ('event', 'message', 'heights')
+
+	def __init__(self, event:dict):
+		self.event = event
+		self.message = None
+		self.heights = None
+
 class MessageQueues:
+	"""
+	Queues of events to display, per room.
+		Events are stored as QueuedEvents in a Timeline, sorted by (origin_server_ts, event_id) as they're queued,
+		so events arriving out of order (e.g. from backfills) never need the whole queue sorting again.
+		Events are only built into Messages when they are read with getMessage or iterMessages.
+		Queued events are indexed by event ID, so redactions and lookups don't scan the queue.
+		Events already in a room's queue aren't queued again.
+		Messages being sent are queued straight away as local echoes, keyed by transaction ID, showing their send status,
+		and replaced in place when the homeserver's copy arrives.
+		At most materializedLimit Messages are kept built per room; the least recently used are evicted.
+		Each room also has a HeightIndex per display width, so displays can find the messages covering any row.
+		Heights of messages which haven't been measured at a width yet are estimated.
+
+	Class Attributes:
+		materializedLimit (int): Maximum number of built Messages to keep per room
+		estimatedHeight (int): Height assumed for messages which haven't been measured
+		heightIndexWidths (int): Maximum number of widths to keep a HeightIndex for, per room
+	"""
+
+	materializedLimit = 500
+	estimatedHeight = 1
+	heightIndexWidths = 2
+
 	def __init__(self):
 		self.queues = {}
 		# Structure:
-		# {'room_id': [Message, Message, Message...]}
+		# {'room_id': Timeline(QueuedEvent, QueuedEvent, QueuedEvent...)}
 		# Keys are Room.room_id
-		# Values are lists of Messsages
-		# 	(These would be collections.deque, but those don't support sorts or slicing)
-		# 	Message lists are ordered new to old
+		# Values are Timelines of QueuedEvents, ordered old to new
+		self.materialized = {}
+		# Structure:
+		# {'room_id': OrderedDict(QueuedEvent: None, ...)}
+		# QueuedEvents which currently have a Message built, least recently used first
+		self.heightIndexes = {}
+		# Structure:
+		# {'room_id': {width: HeightIndex}}
+		# HeightIndex positions count from the oldest QueuedEvent in the room's queue
+		self.eventIndexes = {}
+		# Structure:
+		# {'room_id': {'event_id': QueuedEvent}}
+		self.pendingRedactions = {}
+		# Structure:
+		# {'room_id': {'event_id': redaction event}}
+		# Redactions of events which aren't queued yet (e.g. haven't been backfilled), applied when they are
+		self.echoes = {}
+		# Structure:
+		# {'room_id': {'transaction_id': 'local event_id'}}
+		# Local echoes waiting for the homeserver's copy of their event
+		self.echoIds = {}
+		# Structure:
+		# {'room_id': {'event_id': 'transaction_id'}}
+		# Event IDs the homeserver gave sent local echoes, for copies which arrive without their transaction ID
 
 	def buildAndEnqueue(self, event:dict, room:matrix_client.room.Room):
 		"""
-		Build a Message from an event, then queue that Message in a room's queue
+		Queue an event in a room's queue, to be built into a Message when displayed
 		
 		Args:
-			event (dict): Event to build a Message for and queue
+			event (dict): Event to queue
 			room (matrix_client.room.Room): Room in which to queue it
 		"""
 
-		message = MessageBuilder.initMessage(event, room)
-		if isinstance(message, RoomRedaction):
+		if RoomRedaction.matchesStructure(event):
 			self.redact(event, room)
-		self.enqueue(message, room)
+		self.enqueue(event, room)
 
-	def enqueue(self, message:Message, room:matrix_client.room.Room):
+	def buildAndEnqueueMany(self, events:list, room:matrix_client.room.Room):
 		"""
-		Queue a Message in a room's queue
+		Queue a chunk of events in a room's queue, to be built into Messages when displayed
+			The chunk is merged into the queue as one run, rather than handling each event separately.
 		
 		Args:
-			message (Message): Message to queue
+			events (list): Events to queue, in any order
+			room (matrix_client.room.Room): Room in which to queue them
+		"""
+
+		if room.room_id not in self.queues: self.queues[room.room_id] = Timeline()
+		queue = self.queues[room.room_id]
+		display_logger.debug('Queueing %(count)d events to room %(roomId)s' %
+			{'count': len(events),
+			'roomId': room.room_id})
+
+		run = []
+		for event in events:
+			if self.reconcileEcho(event, room): continue
+			queued = self._newQueued(event, room)
+			if queued is not None: run.append((self.eventKey(event), queued))
+
+		length = len(queue)
+		lowest = queue.merge(run)
+		if lowest >= length:
+			# All newer than the rest of the queue, so positions of existing events haven't moved
+			for heightIndex in self.heightIndexes.get(room.room_id, {}).values():
+				for _ in run: heightIndex.append(self.estimatedHeight)
+		else:
+			# Positions have moved, so the height indexes are rebuilt when next needed
+			self.heightIndexes.pop(room.room_id, None)
+		for event in events:
+			if RoomRedaction.matchesStructure(event):
+				self.redact(event, room)
+
+	def enqueue(self, event:dict, room:matrix_client.room.Room):
+		"""
+		Queue an event in a room's queue
+		
+		Args:
+			event (dict): Event to queue
 			room (matrix_client.room.Room): Room in which to queue it
 		"""
 
-		if room.room_id not in self.queues: self.queues[room.room_id] = []
-		display_logger.debug('Queueing Message to room %(roomId)s: %(message)s' %
+		if room.room_id not in self.queues: self.queues[room.room_id] = Timeline()
+		queue = self.queues[room.room_id]
+		display_logger.debug('Queueing event to room %(roomId)s: %(eventId)s' %
 			{'roomId':room.room_id,
-			'message':str(message)})
+			'eventId':str(event.get('event_id'))})
+
+		if self.reconcileEcho(event, room): return
+		queued = self._newQueued(event, room)
+		if queued is None: return
+		position = queue.add(self.eventKey(event), queued)
+		if position == len(queue) - 1:
+			for heightIndex in self.heightIndexes.get(room.room_id, {}).values():
+				heightIndex.append(self.estimatedHeight)
+		else:
+			# Positions have moved, so the height indexes are rebuilt when next needed
+			self.heightIndexes.pop(room.room_id, None)
+
+	def addEcho(self, event:dict, room:matrix_client.room.Room):
+		"""
+		Queue a local echo of an event being sent, to show until the homeserver's copy arrives.
+		
+		Args:
+			event (dict): The event being sent, with a local event_id and unsigned.transaction_id
+			room (matrix_client.room.Room): Room it's being sent to
+		"""
+
+		self.enqueue(event, room)
+		if room.room_id not in self.echoes: self.echoes[room.room_id] = {}
+		self.echoes[room.room_id][event['unsigned']['transaction_id']] = event['event_id']
+
+	def confirmEcho(self, room:matrix_client.room.Room, transactionId:str, eventId:str):
+		"""
+		Record the event ID the homeserver gave a sent local echo, so its copy is recognized even without the transaction ID.
+		
+		Args:
+			room (matrix_client.room.Room): Room the event was sent to
+			transactionId (str): Transaction ID the event was sent with
+			eventId (str): Event ID the homeserver gave it
+		"""
+
+		if transactionId not in self.echoes.get(room.room_id, {}): return # Its copy has already arrived
+		if room.room_id not in self.echoIds: self.echoIds[room.room_id] = {}
+		self.echoIds[room.room_id][eventId] = transactionId
+
+	def reconcileEcho(self, event:dict, room:matrix_client.room.Room) -> bool:
+		"""
+		If an event is the homeserver's copy of a local echo, replace the echo with it.
+		
+		Args:
+			event (dict): Event arriving from the homeserver
+			room (matrix_client.room.Room): Room it arrived in
+		
+		Returns:
+			bool: Whether the event replaced a local echo
+		"""
+
+		echoes = self.echoes.get(room.room_id)
+		if not echoes: return(False)
+		transactionId = event.get('unsigned', {}).get('transaction_id')
+		if transactionId not in echoes:
+			transactionId = self.echoIds.get(room.room_id, {}).get(event.get('event_id'))
+			if transactionId not in echoes: return(False)
+
+		self.echoIds.get(room.room_id, {}).pop(event.get('event_id'), None)
+		queued, oldPosition = self._dropEcho(room, transactionId)
+		queued.event = event
+		self.eventIndexes[room.room_id][event['event_id']] = queued
+		position = self.queues[room.room_id].add(self.eventKey(event), queued)
+		if position == oldPosition:
+			for heightIndex in self.heightIndexes.get(room.room_id, {}).values():
+				heightIndex.update(position, self.estimatedHeight)
+		else:
+			# Positions have moved, so the height indexes are rebuilt when next needed
+			self.heightIndexes.pop(room.room_id, None)
+		return(True)
+
+	def setEchoStatus(self, room:matrix_client.room.Room, transactionId:str, status:str):
+		"""
+		Set the send status shown on a local echo.
+		
+		Args:
+			room (matrix_client.room.Room): Room it was queued in
+			transactionId (str): Transaction ID it's being sent with
+			status (str or None): Status to show, e.g. 'sending'. None to show none.
+		"""
+
+		localId = self.echoes.get(room.room_id, {}).get(transactionId)
+		if localId is None: return # Its copy has already arrived
+		queued = self.eventIndexes[room.room_id][localId]
+		unsigned = dict(queued.event.get('unsigned', {}))
+		if status is None: unsigned.pop(Message.sendStatusKey, None)
+		else: unsigned[Message.sendStatusKey] = status
+		self.replaceEvent(queued, dict(queued.event, unsigned=unsigned), room)
+
+	def _dropEcho(self, room:matrix_client.room.Room, transactionId:str) -> tuple:
+		# Take a local echo out of the queue and indexes, returning (its QueuedEvent, the position it was at)
+		localId = self.echoes[room.room_id].pop(transactionId)
+		queued = self.eventIndexes[room.room_id].pop(localId)
+		position = self.queues[room.room_id].remove(self.eventKey(queued.event))
+		queued.message = None
+		queued.heights = None
+		self.materialized.get(room.room_id, {}).pop(queued, None)
+		Message.renderCache.discard(localId)
+		return((queued, position))
+
+	@staticmethod
+	def eventKey(event:dict) -> tuple:
+		"""
+		Get the key events are ordered by in queues.
+		
+		Args:
+			event (dict): Event to get the key of
+		
+		Returns:
+			tuple: (origin_server_ts, event_id)
+		"""
+
+		return((int(event.get('origin_server_ts', 0)), event.get('event_id', '')))
+
+	def _newQueued(self, event:dict, room:matrix_client.room.Room) -> QueuedEvent:
+		"""
+		Make a QueuedEvent for an event and add it to the room's event index, applying any pending redaction of it.
+		
+		Args:
+			event (dict): Event to queue
+			room (matrix_client.room.Room): Room it's being queued in
+		
+		Returns:
+			QueuedEvent or None: The QueuedEvent, or None if the event is already queued
+		"""
 
-		self.queues[room.room_id].insert(0, message)
+		if room.room_id not in self.eventIndexes: self.eventIndexes[room.room_id] = {}
+		eventIndex = self.eventIndexes[room.room_id]
+		eventId = event.get('event_id')
+		if eventId is not None and eventId in eventIndex: return(None)
 
+		redaction = self.pendingRedactions.get(room.room_id, {}).pop(eventId, None)
+		if redaction is not None:
+			event = redactedEvent(event, redaction)
+		queued = QueuedEvent(event)
+		if eventId is not None: eventIndex[eventId] = queued
+		return(queued)
 
 	def redact(self, event:dict, room:matrix_client.room.Room):
 		"""
 		Redact a Message from a room.
+			The redacted event is replaced in place, and only its own render is invalidated.
+			If the redacted event isn't queued yet, it's redacted when it is.
 		
 		Args:
 			event (dict): Event of the redaction. Note that this is *NOT* the event being redacted.
 			room (matrix_client.room.Room): Room in which to perform the redaction.
 		"""
 
-		for message in self.queues[room.room_id]:
-			if message.event['event_id'] == event['redacts']:
-				redactedEvent = {
-					'event_id': message.event['event_id'],
-					'sender': message.event['sender'],
-					'origin_server_ts': message.event['origin_server_ts'],
-					'unsigned': {
-						'redacted_because': {
-							'event_id': event['event_id']
-						}
-					}
-				}
-				message = RedactedEvent(redactedEvent, room)
-				return
+		queued = self.eventIndexes.get(room.room_id, {}).get(event['redacts'])
+		if queued is None:
+			if room.room_id not in self.pendingRedactions: self.pendingRedactions[room.room_id] = {}
+			self.pendingRedactions[room.room_id][event['redacts']] = event
+			return
+		if RedactedEvent.matchesStructure(queued.event): return
 
+		self.replaceEvent(queued, redactedEvent(queued.event, event), room)
 
-	def sortQueue(self, room:matrix_client.room.Room):
+	def replaceEvent(self, queued:QueuedEvent, event:dict, room:matrix_client.room.Room):
 		"""
-		Sort a room queue by timestamp (in-place)
+		Replace a queued event with a new version of it, invalidating only its own Message and renders.
 		
 		Args:
-			room (matrix_client.room.Room): Room for which to sort the queue
+			queued (QueuedEvent): Queued event to replace
+			event (dict): The new version. Must have the same event_id and origin_server_ts, so it stays in place.
+			room (matrix_client.room.Room): Room it's queued in
 		"""
 
-		self.queues[room.room_id].sort(key=lambda message: int(message.event['origin_server_ts']), reverse=True)
+		queued.event = event
+		queued.message = None
+		queued.heights = None
+		self.materialized.get(room.room_id, {}).pop(queued, None)
+		Message.renderCache.discard(event['event_id'])
+
+		heightIndexes = self.heightIndexes.get(room.room_id, {})
+		if heightIndexes:
+			position = self.queues[room.room_id].position(self.eventKey(event))
+			for heightIndex in heightIndexes.values():
+				heightIndex.update(position, self.estimatedHeight)
+
+	def getOldest(self, room:matrix_client.room.Room) -> dict:
+		"""
+		Get the oldest queued event in a room.
+		
+		Args:
+			room (matrix_client.room.Room): Room to look in
+		
+		Returns:
+			dict or None: The oldest event, or None if the queue is empty
+		"""
+
+		queue = self.queues.get(room.room_id)
+		if not queue: return(None)
+		return(queue[0].event)
+
+	def getEvent(self, room:matrix_client.room.Room, eventId:str) -> dict:
+		"""
+		Get a queued event by event ID.
+		
+		Args:
+			room (matrix_client.room.Room): Room in which to look for the event
+			eventId (str): Matrix event ID
+		
+		Raises:
+			KeyError: If the event isn't queued.
+				Usually this is because it's not been backfilled in yet.
+		
+		Returns:
+			dict: The event dict, as queued (so redacted events are returned redacted)
+		"""
+
+		queued = self.eventIndexes.get(room.room_id, {}).get(eventId)
+		if queued is None:
+			raise KeyError('Event %(eventId)s not queued in room %(roomId)s' %
+				{'eventId': str(eventId),
+				'roomId': room.room_id})
+		return(queued.event)
+
 
 	def getQueue(self, room:matrix_client.room.Room, start:int = 0, count:int = 0) -> list:
-		#display_logger.debug('Queues: '+str(self.queues))
-		if count is 0:
-			return(self.queues[room.room_id][start:])
-		return(self.queues[room.room_id][start:start+count])
+		"""
+		Get part of a room's queue, without building any Messages.
+		
+		Args:
+			room (matrix_client.room.Room): Room to get the queue of
+			start (int, optional): Defaults to 0. Index to start from (0 is the newest event)
+			count (int, optional): Defaults to 0. Number of events to get. 0 gets the whole rest of the queue.
+		
+		Returns:
+			list: QueuedEvents, ordered new to old
+		"""
+
+		queue = self.queues[room.room_id]
+		stop = len(queue) - start
+		if count == 0:
+			return(queue.slice(0, stop)[::-1])
+		return(queue.slice(stop - count, stop)[::-1])
+
+	def getMessage(self, queued:QueuedEvent, room:matrix_client.room.Room) -> Message:
+		"""
+		Get the Message for a queued event, building it if it isn't already.
+			Evicts the least recently used Messages in the room if there are more than materializedLimit.
+		
+		Args:
+			queued (QueuedEvent): Queued event to get the Message for
+			room (matrix_client.room.Room): Room the event is queued in
+		
+		Returns:
+			Message: The built Message
+		"""
+
+		if room.room_id not in self.materialized: self.materialized[room.room_id] = collections.OrderedDict()
+		materialized = self.materialized[room.room_id]
+
+		if queued.message is None:
+			queued.message = MessageBuilder.initMessage(queued.event, room)
+			materialized[queued] = None
+			while len(materialized) > self.materializedLimit:
+				evicted, _ = materialized.popitem(last=False)
+				evicted.message = None
+		else:
+			materialized.move_to_end(queued)
+		return(queued.message)
+
+	def iterMessages(self, room:matrix_client.room.Room, start:int = 0):
+		"""
+		Iterate over the Messages in a room's queue, building each only as it's reached.
+		
+		Args:
+			room (matrix_client.room.Room): Room to iterate over
+			start (int, optional): Defaults to 0. Index to start from (0 is the newest event)
+		
+		Yields:
+			Message: Messages, ordered new to old
+		"""
+
+		queue = self.queues.get(room.room_id, [])
+		for i in range(len(queue) - 1 - start, -1, -1):
+			yield(self.getMessage(queue[i], room))
+
+	def getHeightIndex(self, room:matrix_client.room.Room, width:int) -> HeightIndex:
+		"""
+		Get the HeightIndex of a room's queue at a width, building it if needed.
+		
+		Args:
+			room (matrix_client.room.Room): Room to get the index for
+			width (int): Display width the heights are for
+		
+		Returns:
+			HeightIndex: Heights of the room's messages, oldest first
+		"""
+
+		if room.room_id not in self.heightIndexes: self.heightIndexes[room.room_id] = {}
+		heightIndexes = self.heightIndexes[room.room_id]
+		if width not in heightIndexes:
+			if len(heightIndexes) >= self.heightIndexWidths:
+				del heightIndexes[next(iter(heightIndexes))]
+			heightIndexes[width] = HeightIndex(self._knownHeight(queued, width)
+				for queued in self.queues.get(room.room_id, []))
+		return(heightIndexes[width])
+
+	def _knownHeight(self, queued:QueuedEvent, width:int) -> int:
+		if queued.heights is None: return(self.estimatedHeight)
+		return(queued.heights.get(width, self.estimatedHeight))
+
+	def measure(self, room:matrix_client.room.Room, position:int, width:int) -> Message:
+		"""
+		Build the Message at a position in a room's queue, and record its height at a width.
+		
+		Args:
+			room (matrix_client.room.Room): Room the message is queued in
+			position (int): Position of the message, counting from 0 at the oldest
+			width (int): Width to build the Message at
+		
+		Returns:
+			Message: The built Message
+		"""
+
+		queued = self.queues[room.room_id][position]
+		message = self.getMessage(queued, room)
+		message.build(width)
+		if queued.heights is None: queued.heights = {}
+		queued.heights[width] = message.height
+		self.getHeightIndex(room, width).update(position, message.height)
+		return(message)
+
+class RedrawScheduler:
+	"""
+	Coalesces redraws of the display's regions into at most maxFps screen updates per second.
+		Regions are scheduled with a draw function, which should draw with noutrefresh rather than refresh.
+		On update, every pending draw is run and the screen is updated once, with curses.doupdate.
+		Updates which come too soon after the last are left pending until the next update or tick.
+	
+	Args:
+		maxFps (int): Maximum number of screen updates per second
+
+	Attributes:
+		interval (float): Minimum time between screen updates, in seconds
+		pending (dict): Draw functions waiting for the next update, keyed by region name
+		cursorWindow (curses.window or None): Window refreshed last on each update, so the cursor is left in it
+	"""
+
+	def __init__(self, maxFps:int = 30):
+		self.interval = 1 / maxFps
+		self.pending = {}
+		self.cursorWindow = None
+		self.lastUpdate = 0
+		self.lock = threading.RLock()
+
+	def schedule(self, region:str, draw:callable, force:bool = False):
+		"""
+		Schedule a region to be redrawn, replacing any pending draw for it, and update if it's time to.
+		
+		Args:
+			region (str): Name of the region, e.g. 'status'
+			draw (callable): Function drawing the region
+			force (bool, optional): Defaults to False. If set, update now even if the last update was too recent.
+		"""
+
+		with self.lock:
+			self.pending[region] = draw
+		self.update(force=force)
+
+	def update(self, force:bool = False) -> bool:
+		"""
+		Run the pending draws and update the screen, unless the last update was too recent.
+		
+		Args:
+			force (bool, optional): Defaults to False. If set, update even if the last update was too recent.
+		
+		Returns:
+			bool: Whether the screen was updated
+		"""
+
+		with self.lock:
+			if not self.pending: return(False)
+			now = time.monotonic()
+			if not force and now - self.lastUpdate < self.interval: return(False)
+
+			pending, self.pending = self.pending, {}
+			for region, draw in pending.items():
+				try:
+					draw()
+				except curses.error as e:
+					display_logger.warning('Error when drawing %(region)s: %(error)s' %
+						{'region': region,
+						'error': str(e)})
+			if self.cursorWindow is not None:
+				self.cursorWindow.noutrefresh()
+			curses.doupdate()
+			self.lastUpdate = now
+			return(True)
 
 class DisplayController:
+	"""
+	Owns the windows of the display, and routes updates to them through a RedrawScheduler.
+
+	Attributes:
+		historyHandler (callable or None): Called with the current room when scrolling comes within backfillPages
+			of the oldest loaded message, to load older history. It shouldn't block.
+		idleHandler (callable or None): Called on each tick, for work to do while input is idle
+
+	Class Attributes:
+		maxFps (int): Maximum number of screen updates per second
+			Input is also polled at this rate, so pending updates are drawn between keystrokes
+		backfillPages (int): Pages of loaded history left above the view at which to load more
+	"""
+
+	maxFps = 30
+	backfillPages = 4
+
 	def __init__(self, screen:"curses.window"):
 		self.screen = screen
 		curses.use_default_colors()
 		curses.init_color(curses.COLOR_WHITE, 500, 500, 500)
 		curses.init_pair(1, curses.COLOR_WHITE, -1)
 		screen.bkgd(curses.color_pair(1))
+		self.scheduler = RedrawScheduler(self.maxFps)
+		self.screen.timeout(self.tickTimeout)
 		self.messageDisplay = None
 		self.buildWindows()
-		self.offset = 0
+		self.offset = 0 # Rows scrolled up from the newest message
 		self.currentRoom = None
+		self.historyHandler = None
+		self.idleHandler = None
 		self.mode = MODES.EDIT
 
+	@property
+	def tickTimeout(self) -> int:
+		"""
+		Time, in milliseconds, input should wait for a keystroke before calling DisplayController.tick.
+		"""
+		return(max(int(self.scheduler.interval * 1000), 1))
+
+	def tick(self):
+		"""
+		Called by input listeners when no input has arrived for tickTimeout.
+			Runs the idleHandler, then draws any updates which were left pending.
+		"""
+		if self.idleHandler is not None: self.idleHandler()
+		self.scheduler.update()
+
+	@property
+	def pageHeight(self) -> int:
+		"""
+		Rows to scroll by for a page up or page down. Keeps one row of overlap.
+		"""
+		return(max(self.messageDisplay.height - 1, 1))
+
 	def setMode(self, mode:MODES, inputListener:callable):
 		if not isinstance(mode, MODES):
 			raise InvalidModeError('Tried to enter invalid mode: '+str(mode))
@@ -134,7 +634,7 @@ class DisplayController:
 		statusX = 0
 		statusWidth = self.width - statusX
 		statusWindow = self.screen.subwin(statusHeight, statusWidth, statusY, statusX)
-		self.statusDisplay = StatusDisplay(statusWindow, statusY, statusX)
+		self.statusDisplay = StatusDisplay(statusWindow, statusY, statusX, self.scheduler)
 
 		messageY = statusY + statusHeight
 		messageX = 0
@@ -151,34 +651,90 @@ class DisplayController:
 			inputX = 0
 			inputWidth = self.width - inputX
 			self.inputWindow = self.screen.subwin(inputHeight, inputWidth, inputY, inputX)
+			self.inputWindow.timeout(self.tickTimeout)
 			self.inputBox = InputBox(self.inputWindow, inputY, inputX)
+			self.scheduler.cursorWindow = self.inputWindow
 		else:
 			self.inputBox = None
+			self.scheduler.cursorWindow = None
 
-	def changeRoom(self, room:matrix_client.room.Room, sortFirst:bool=False):
-		if sortFirst: self.messageDisplay.messageQueues.sortQueue(room)
+	def changeRoom(self, room:matrix_client.room.Room):
 		if room is not self.currentRoom:
 			self.currentRoom = room
-			self.messageDisplay.printQueue(room, offset=self.offset)
+			self.redrawMessages(force=True)
 		else:
 			self.offset = 0
-			self.messageDisplay.printQueue(room, offset=self.offset)
+			self.redrawMessages(force=True)
 			# TODO: Update status etc
 
+	def redrawMessages(self, force:bool = False):
+		"""
+		Schedule the message display to be redrawn.
+		
+		Args:
+			force (bool, optional): Defaults to False. If set, redraw now rather than waiting for the next frame.
+		"""
+		self.scheduler.schedule('messages', self._drawMessages, force=force)
+
+	def _drawMessages(self):
+		topSpace = self.messageDisplay.printQueue(self.currentRoom, offset=self.offset)
+		if topSpace > 0 and self.offset > 0:
+			# Estimated heights were too high, so we scrolled past the oldest message. Settle against it.
+			self.offset = max(self.offset - topSpace, 0)
+			self.messageDisplay.printQueue(self.currentRoom, offset=self.offset)
+
 	def changeOffset(self, amount:int):
+		"""
+		Scroll the message display.
+		
+		Args:
+			amount (int): Rows to scroll up by. Negative to scroll down.
+		"""
+		if self.currentRoom is None: return # Nothing to scroll until a room is open
 		display_logger.debug('changeOffset called. Current offset: '+str(self.offset)+', amount: '+str(amount))
-		self.offset += amount
-		if self.offset < 0: self.offset = 0
-		topSpace = self.messageDisplay.printQueue(self.currentRoom, offset=self.offset)
-		while topSpace > 1 and self.offset > 0:
-			self.offset -= 1
-			topSpace = self.messageDisplay.printQueue(self.currentRoom, offset=self.offset)
+		heightIndex = self.messageDisplay.messageQueues.getHeightIndex(self.currentRoom, self.messageDisplay.width)
+		maxOffset = max(heightIndex.total() - self.messageDisplay.height, 0)
+		self.offset = min(max(self.offset + amount, 0), maxOffset)
+		self.redrawMessages(force=True)
 		display_logger.debug('New offset: '+str(self.offset))
+		if amount > 0 and self.historyHandler is not None and self.nearOldest:
+			self.historyHandler(self.currentRoom)
+
+	@property
+	def nearOldest(self) -> bool:
+		"""
+		Whether the message display is within backfillPages of the oldest loaded message, so more history should be loaded.
+		"""
+		if self.currentRoom is None: return(False)
+		return(self.rowsAbove <= self.backfillPages * self.pageHeight)
+
+	@property
+	def rowsAbove(self) -> int:
+		"""
+		Rows of loaded history above the top of the message display.
+		"""
+		heightIndex = self.messageDisplay.messageQueues.getHeightIndex(self.currentRoom, self.messageDisplay.width)
+		return(max(heightIndex.total() - self.offset - self.messageDisplay.height, 0))
 
 	def enqueue(self, event:dict, room:matrix_client.room.Room):
 		self.messageDisplay.messageQueues.buildAndEnqueue(event, room)
 		if room is self.currentRoom:
-			self.messageDisplay.printQueue(self.currentRoom, offset=self.offset)
+			self.redrawMessages()
+
+	def enqueueMany(self, events:list, room:matrix_client.room.Room):
+		self.messageDisplay.messageQueues.buildAndEnqueueMany(events, room)
+		if room is self.currentRoom:
+			self.redrawMessages()
+
+	def echo(self, event:dict, room:matrix_client.room.Room):
+		self.messageDisplay.messageQueues.addEcho(event, room)
+		if room is self.currentRoom:
+			self.redrawMessages(force=True)
+
+	def setEchoStatus(self, room:matrix_client.room.Room, transactionId:str, status:str):
+		self.messageDisplay.messageQueues.setEchoStatus(room, transactionId, status)
+		if room is self.currentRoom:
+			self.redrawMessages()
 
 class InputBox:
 	def __init__(self, screen:"curses.window", y:int, x:int):
@@ -205,11 +761,17 @@ class InputBox:
 class MessageDisplay:
 	"""
 	Section of the screen in which messages are displayed.
+		Keeps track of what is shown on each row, so redraws only rewrite the rows which changed,
+		and scroll the window when the same rows have just moved up.
 
 	Arguments:
 		window ("curses.window"): Window object to use
 		y (int): Top of the window
 		x (int): Left of the window
+
+	Attributes:
+		shownRows (list or None): What each row of the window shows, as (pad, padRow, renderSerial) or None for blank rows.
+			None if the window's contents are unknown.
 	"""
 
 	def __init__(self, window:"curses.window", y:int, x:int):
@@ -230,85 +792,158 @@ class MessageDisplay:
 		self.y = y
 		self.x = x
 		self.window = window
+		self.window.scrollok(True)
+		self.window.idlok(True) # Lets curses use the terminal's own scrolling
 		self.height, self.width = window.getmaxyx()
+		self.shownRows = None
 
 	def printQueue(self, room:matrix_client.room.Room, offset:int = 0) -> int:
 		"""
 		Print the MessageQueue to the screen.
+			The room's HeightIndex is used to jump straight to the messages covering the visible rows,
+			so only those are built and printed, however long the queue is.
+			This only draws to the virtual screen; call curses.doupdate (or use a RedrawScheduler) to show it.
 		
 		Args:
 			room (matrix_client.room.Room): Room to print
-			offset (int, optional): Defaults to 0. If set, starts from the nth oldest message.
+			offset (int, optional): Defaults to 0. If set, scrolls up that many rows from the newest message.
 
 		Returns:
 			int: Number of empty lines at the top of the screen
 		"""
 
-		self.window.clear()
-		self.window.refresh()
+		heightIndex = self.messageQueues.getHeightIndex(room, self.width)
+		bottomRow = heightIndex.total() - offset # First row below the screen, counting from the top of the oldest message
+		position = heightIndex.find(bottomRow - 1) if bottomRow > 0 else -1 # Message covering the bottom row of the screen
+		hiddenBelow = heightIndex.prefix(position + 1) - bottomRow # Rows of that message below the screen
 
-		messages = self.messageQueues.getQueue(room, start=offset)#, count=self.height)
-		# We just get the entire queue, as otherwise hidden message mess stuff up
-		# Plus it's not like the memory usage will cause issues unless you somehow load many tens of thousands of messages
+		display_logger.debug('Printing queue from position %(position)d, offset %(offset)d' %
+			{'position': position,
+			'offset': offset})
 
-		display_logger.debug('Printing queue. Length: '+str(len(messages)))
+		rows = [None] * self.height
+		y = self.height - 1 + max(hiddenBelow, 0) # Bottom of the message being printed, relative to the window
+		while position >= 0 and y >= 0:
+			message = self.messageQueues.measure(room, position, self.width)
+			position -= 1
 
-		y = self.height + self.y
-		for message in messages:
-			if y < self.y: break
+			top = y - (message.height - 1)
+			for padRow in range(max(-top, 0), message.height):
+				if top + padRow < self.height:
+					rows[top + padRow] = (message.pad, padRow, message.renderSerial)
 
-			pad = message.build(self.width)
-			try:
-				writeHeight = getLastChar2(pad)[0]
+			y -= message.height # Step back the height of the message
 
-				writeTop = y - writeHeight
-				padTop = max(self.y - writeTop, 0)
-				if writeTop < self.y:
-					writeTop = self.y
+		self.drawRows(rows)
 
-				pad.refresh(padTop,0, writeTop,self.x, y,self.x+self.width)		
+		display_logger.debug('printQueue returned: '+str(max(y+1, 0)))
 
-				y -= writeHeight + 1 # Step back the height of the message, plus one (otherwise we'd just overwrite the same one line)
+		return(max(y+1, 0))
 
-			except IndexError:
-				# If the pad doesn't have any characters in it, we don't want to step up
-				pass
+	def drawRows(self, rows:list):
+		"""
+		Update the window to show the given rows, rewriting only the rows which changed.
+			If the new rows are the shown rows moved up (e.g. when a message arrives) or down (e.g. on scrolling back),
+			the window is scrolled first.
+		
+		Args:
+			rows (list): What each row of the window should show, as (pad, padRow, renderSerial) or None for blank rows
+		"""
 
-		display_logger.debug('printQueue returned: '+str(max(y-self.y, 0)))
+		shown = self.shownRows
+		if shown is None or len(shown) != len(rows):
+			self.window.erase()
+			shown = [None] * len(rows)
+		else:
+			shift = self._findShift(shown, rows)
+			if shift > 0:
+				self.window.scroll(shift)
+				shown = shown[shift:] + [None] * shift
+			elif shift < 0:
+				self.window.scroll(shift)
+				shown = [None] * -shift + shown[:shift]
+
+		for y, row in enumerate(rows):
+			if row == shown[y]: continue
+			self.window.move(y, 0)
+			self.window.clrtoeol()
+			if row is not None:
+				pad, padRow, _ = row
+				pad.overwrite(self.window, padRow,0, y,0, y,self.width-1)
+
+		self.shownRows = rows
+		self.window.noutrefresh()
+
+	@staticmethod
+	def _findShift(shown:list, rows:list) -> int:
+		"""
+		Find how far rows have moved up since they were shown.
+		
+		Args:
+			shown (list): Rows currently shown
+			rows (list): Rows to show
+		
+		Returns:
+			int: Number of rows the shown rows have moved up (negative for down), or 0 if they haven't just moved
+		"""
 
-		return(max(y-self.y, 0))
+		if rows == shown: return(0)
+		for shift in range(1, len(rows)):
+			overlap = rows[:len(rows)-shift]
+			if overlap == shown[shift:] and any(row is not None for row in overlap):
+				return(shift)
+			overlap = rows[shift:]
+			if overlap == shown[:len(rows)-shift] and any(row is not None for row in overlap):
+				return(-shift)
+		return(0)
 
 class StatusDisplay:
-	def __init__(self, screen, y, x):
+	def __init__(self, screen, y, x, scheduler:RedrawScheduler):
 		self.screen = screen
 		self.y = y
 		self.x = x
 		self.height, self.width = screen.getmaxyx()
+		self.scheduler = scheduler
+		self.status = ''
+		self.shownStatus = None
 
 	def printStatus(self, status: str) -> None:
+		"""
+		Set the status, and draw it now along with any other pending redraws.
+			Status changes are infrequent and usually come before a slow operation, so they aren't delayed.
+		
+		Args:
+			status (str): Status to show
+		"""
 		display_logger.info('Status: '+status)
 		if len(status) >= self.width:
 			status = status[:self.width-4] + '...'
-		self.screen.clear()
+		self.status = status
+		self.scheduler.schedule('status', self.drawStatus, force=True)
+
+	def drawStatus(self) -> None:
+		if self.status == self.shownStatus: return
+		self.screen.erase()
 		try:
-			self.screen.addstr(0,0,status,curses.color_pair(1))
+			self.screen.addstr(0,0,self.status,curses.color_pair(1))
 		except curses.error as e:
-			self.screen.clear()
+			self.screen.erase()
 			self.screen.addstr(0,0,'Nutmeg')
 			display_logger.warning('Error when printing status: '+str(e))
 			display_logger.info('Printing "Nutmeg" instead.')
-		self.screen.refresh()
+		self.shownStatus = self.status
+		self.screen.noutrefresh()
 	
 	def printRoomHeader(self, room, loading=False):
-		room.update_room_topic()
-		room.update_room_name()
-		topic = room.topic
+		# Drawn from the locally kept state, so switching rooms needs no network I/O
+		roomState = RoomStates.get(room)
+		topic = roomState.topic
 		display_logger.info('Topic: '+str(topic))
 		if not topic: topic = '(No topic)'
 		#if len(topic) > 23: topic = topic[:20] + '...'
 		status = ('%(user)s - %(roomName)s - %(topic)s' %
-			{'user': str(getMember(room, room.client.user_id).get_display_name()),
-			'roomName': str(room.display_name),
+			{'user': str(roomState.getDisplayName(room.client.user_id)),
+			'roomName': str(roomState.getRoomName(room.client.user_id)),
 			'topic': str(topic)})
 		if loading is True:
 			status = '(Loading) ' + status
@@ -325,6 +960,9 @@ class StatusDisplay:
 			'homeServer': server})
 		self.printStatus(status)
 
+	def printNotInRoom(self):
+		self.printStatus('Not in a room yet')
+
 	def printJoining(self, roomId):
 		status = ('Joining %(roomId)s...' % 
 			{'roomId': roomId})
@@ -0,0 +1,136 @@
+"""
+Running network I/O concurrently, off the UI thread.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import queue
+import threading
+import requests.adapters
+
+import logging
+engine_logger = logging.getLogger('root')
+
+class Engine:
+	"""
+	Runs network I/O as asyncio tasks, on an event loop in a background thread.
+		matrix_client's API is blocking, so each call is run on the loop's thread pool executor;
+		the tasks still run concurrently (e.g. the sync long-poll, and backfills of several rooms at once),
+		sharing one pool of HTTP connections sized to match the executor.
+		Results are handed back through a queue, and their callbacks are run on the UI thread when it calls receive,
+		so the input loop never waits on the network.
+
+	Args:
+		api (matrix_client.api.MatrixHttpApi): API whose HTTP session's connection pool is sized to match
+		workerCount (int, optional): Defaults to Engine.defaultWorkerCount. Number of calls which can block at once
+		poolSize (int, optional): Defaults to workerCount. Number of HTTP connections to keep open.
+			Should also cover any other threads using the API (e.g. a SendQueue's workers).
+
+	Class Attributes:
+		defaultWorkerCount (int): Default number of calls which can block at once
+	"""
+
+	defaultWorkerCount = 8
+
+	def __init__(self, api, workerCount:int = None, poolSize:int = None):
+		if workerCount is None: workerCount = self.defaultWorkerCount
+		if poolSize is None: poolSize = workerCount
+		self.workerCount = workerCount
+		self.poolSize = poolSize
+		self.loop = asyncio.new_event_loop()
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workerCount, thread_name_prefix='engine')
+		self.loop.set_default_executor(self.executor)
+		self.completed = queue.Queue()
+		# (callback, concurrent.futures.Future) of finished tasks, waiting for the UI thread
+		self.poolConnections(api)
+		self.thread = threading.Thread(target=self._run, name='engine', daemon=True)
+		self.thread.start()
+
+	def _run(self):
+		asyncio.set_event_loop(self.loop)
+		self.loop.run_forever()
+
+	def poolConnections(self, api):
+		"""
+		Size the API's HTTP connection pool to poolSize, so every worker can hold a connection open at once,
+			rather than connections being dropped and reopened when more calls are in flight than the default pool holds.
+
+		Args:
+			api (matrix_client.api.MatrixHttpApi): API to pool connections for
+		"""
+
+		session = getattr(api, 'session', None)
+		if session is None: return
+		adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.poolSize)
+		session.mount('https://', adapter)
+		session.mount('http://', adapter)
+
+	async def call(self, function:callable, *args, **kwargs):
+		"""
+		Run a blocking function on the executor, without blocking the event loop.
+
+		Args:
+			function (callable): Function to run
+			*args, **kwargs: Arguments to call it with
+
+		Returns:
+			The function's result
+		"""
+
+		return(await self.loop.run_in_executor(None, functools.partial(function, *args, **kwargs)))
+
+	def spawn(self, coroutine, callback:callable = None) -> concurrent.futures.Future:
+		"""
+		Start a coroutine as a task on the event loop. May be called from any thread.
+
+		Args:
+			coroutine (coroutine): Coroutine to run
+			callback (callable, optional): Defaults to None. Called with (result, error) when the task finishes,
+				from the UI thread's next receive. error is None if the task succeeded, otherwise result is None.
+
+		Returns:
+			concurrent.futures.Future: Future of the task's result
+		"""
+
+		future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+		if callback is not None:
+			future.add_done_callback(lambda done: self.completed.put((callback, done)))
+		return(future)
+
+	def run(self, function:callable, *args, callback:callable = None, **kwargs) -> concurrent.futures.Future:
+		"""
+		Run a blocking function as a task, as with call and spawn.
+
+		Args:
+			function (callable): Function to run
+			*args, **kwargs: Arguments to call it with
+			callback (callable, optional): Defaults to None. Called with (result, error) from the UI thread, as with spawn
+
+		Returns:
+			concurrent.futures.Future: Future of the function's result
+		"""
+
+		return(self.spawn(self.call(function, *args, **kwargs), callback=callback))
+
+	def receive(self):
+		"""
+		Run the callbacks of finished tasks. Must be called from the UI thread.
+		"""
+
+		while True:
+			try:
+				callback, future = self.completed.get_nowait()
+			except queue.Empty:
+				return
+			if future.cancelled():
+				result, error = None, concurrent.futures.CancelledError()
+			else:
+				error = future.exception()
+				result = future.result() if error is None else None
+			try:
+				callback(result, error)
+			except Exception as e:
+				engine_logger.error('Exception in callback %(callback)s: %(error)s' %
+					{'callback': str(callback),
+					'error': str(e)})
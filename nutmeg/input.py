@@ -81,7 +81,12 @@ class InputController:
 				self.displayController.clearInput()
 				self.parse(out)
 			elif self.mode is MODES.VISUAL:
-				key = self.displayController.screen.getkey()
+				try:
+					key = self.displayController.screen.getkey()
+				except curses.error:
+					# No input before the timeout
+					self.displayController.tick()
+					continue
 				self.visualInputController(key)
 			
 
@@ -102,8 +107,12 @@ class InputController:
 
 		if self.mode is not MODES.EDIT:
 			raise WrongModeError('Parse.editListener called when not in edit mode.')
-			
-		if keystroke == curses.KEY_ENTER or keystroke == 10:
+
+		if keystroke == -1:
+			# No input before the timeout. Returning 0 makes the Textbox wait for the next keystroke.
+			self.displayController.tick()
+			return(0)
+		elif keystroke == curses.KEY_ENTER or keystroke == 10:
 			# Send the message on enter as well as Ctrl-G
 			return(7) # Ctrl-G
 		elif keystroke in [curses.KEY_HOME, 27]:
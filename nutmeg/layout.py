@@ -0,0 +1,212 @@
+"""
+Text layout for messages, without touching curses.
+	Lays out (text, attr) segments the way curses addstr would write them to a pad of a given width,
+	so message heights can be known (and tested) without a terminal.
+"""
+
+import unicodedata
+
+TABSIZE = 8 # Curses default tab stop interval
+
+def charWidth(char: str) -> int:
+	"""
+	Get the number of terminal cells a character takes up.
+
+	Arguments:
+		char (str): A single character
+
+	Returns:
+		int: 0 for combining characters, 2 for wide characters, otherwise 1
+	"""
+
+	if unicodedata.combining(char): return(0)
+	if unicodedata.east_asian_width(char) in ('W', 'F'): return(2)
+	return(1)
+
+def textWidth(text: str) -> int:
+	"""
+	Get the number of terminal cells a string takes up, if it's all on one line.
+
+	Arguments:
+		text (str): Text to measure
+
+	Returns:
+		int: Width in cells
+	"""
+
+	return(sum(charWidth(char) for char in text))
+
+def layoutSegments(segments: list, width: int) -> list:
+	"""
+	Lay out text segments into lines of a given width.
+		Follows curses' addstr behaviour: text wraps as soon as a line is full (not at word boundaries),
+		newlines end the line, tabs advance to the next tab stop, wide characters which
+		don't fit at the end of a line wrap whole, and other control characters are shown as ^X.
+
+	Arguments:
+		segments (list): List of (text, attr) tuples, in the order they'd be written
+		width (int): Width, in cells, to lay out to
+
+	Returns:
+		list: List of lines, each a list of (text, attr) tuples.
+			Lines contain only printable text, so each segment can be written at its position directly.
+	"""
+
+	lines = [[]]
+	x = 0
+	for text, attr in segments:
+		chunk = ''
+		for char in str(text):
+			if char == '\n':
+				if chunk: lines[-1].append((chunk, attr))
+				chunk = ''
+				lines.append([])
+				x = 0
+				continue
+
+			if char == '\t':
+				cells = ' ' * (TABSIZE - x % TABSIZE)
+			elif unicodedata.category(char) == 'Cc':
+				cells = '^' + chr((ord(char) + 64) % 128)
+			else:
+				cells = char
+
+			for cell in cells:
+				cellWidth = charWidth(cell)
+				if x + cellWidth > width:
+					# Wide characters which don't fit wrap whole
+					if chunk: lines[-1].append((chunk, attr))
+					chunk = ''
+					lines.append([])
+					x = 0
+				chunk += cell
+				x += cellWidth
+				if x >= width:
+					# Like curses, the cursor moves to the next line as soon as a line is filled,
+					# so a newline straight afterwards leaves a blank line
+					lines[-1].append((chunk, attr))
+					chunk = ''
+					lines.append([])
+					x = 0
+		if chunk: lines[-1].append((chunk, attr))
+	return(lines)
+
+def layoutHeight(lines: list) -> int:
+	"""
+	Get the height of laid out lines, ignoring trailing blank lines.
+
+	Arguments:
+		lines (list): Lines, as from layoutSegments
+
+	Returns:
+		int: Number of lines up to and including the last one with visible text. 0 if there is none.
+	"""
+
+	for y in range(len(lines)-1, -1, -1):
+		if any(text.strip() for text, attr in lines[y]):
+			return(y+1)
+	return(0)
+
+class HeightIndex:
+	"""
+	Prefix sums of message heights, in rows, stored as a Fenwick tree.
+		Used to find which messages cover a given row without walking every message before it.
+		Positions count from 0, the oldest message.
+		Appending and updating a height, summing and searching are all O(log n).
+
+	Args:
+		heights (iterable, optional): Initial heights, oldest first
+
+	Attributes:
+		heights (list): Height of each message, oldest first
+	"""
+
+	def __init__(self, heights=()):
+		self.heights = list(heights)
+		self.tree = [0] + self.heights
+		# self.tree[i] holds the sum of heights[i - (i & -i):i]
+		for i in range(1, len(self.tree)):
+			parent = i + (i & -i)
+			if parent < len(self.tree):
+				self.tree[parent] += self.tree[i]
+
+	def __len__(self) -> int:
+		return(len(self.heights))
+
+	def append(self, height: int):
+		"""
+		Add the height of a new newest message.
+
+		Arguments:
+			height (int): Height of the message
+		"""
+
+		i = len(self.heights) + 1
+		self.tree.append(height + self.prefix(i-1) - self.prefix(i - (i & -i)))
+		self.heights.append(height)
+
+	def update(self, position: int, height: int):
+		"""
+		Change the height of a message.
+
+		Arguments:
+			position (int): Position of the message
+			height (int): New height of the message
+		"""
+
+		delta = height - self.heights[position]
+		if delta == 0: return
+		self.heights[position] = height
+		i = position + 1
+		while i < len(self.tree):
+			self.tree[i] += delta
+			i += i & -i
+
+	def prefix(self, position: int) -> int:
+		"""
+		Get the total height of the messages before a position.
+
+		Arguments:
+			position (int): Position to sum up to (exclusive)
+
+		Returns:
+			int: Sum of heights[:position]
+		"""
+
+		total = 0
+		i = position
+		while i > 0:
+			total += self.tree[i]
+			i -= i & -i
+		return(total)
+
+	def total(self) -> int:
+		"""
+		Get the total height of all messages.
+
+		Returns:
+			int: Sum of all heights
+		"""
+
+		return(self.prefix(len(self.heights)))
+
+	def find(self, row: int) -> int:
+		"""
+		Find the message covering a row.
+
+		Arguments:
+			row (int): Row to find, counting from 0 at the top of the oldest message
+
+		Returns:
+			int: Position of the message covering the row.
+				len(self) if the row is past the newest message.
+		"""
+
+		position = 0
+		bit = 1 << (len(self.tree).bit_length() - 1)
+		while bit:
+			if position + bit < len(self.tree) and self.tree[position + bit] <= row:
+				position += bit
+				row -= self.tree[position]
+			bit >>= 1
+		return(position)
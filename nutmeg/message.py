@@ -1,11 +1,17 @@
 try:
-	from .utils import tsToDt, getMember, buildTypeTree, checkStructure
+	from .utils import tsToDt, buildTypeTree, compileStructure
 	from .constants import MTYPE
+	from .layout import layoutSegments, layoutHeight, textWidth
+	from .state import RoomStates
 except ImportError:
-	from utils import tsToDt, getMember, buildTypeTree, checkStructure
+	from utils import tsToDt, buildTypeTree, compileStructure
 	from constants import MTYPE
+	from layout import layoutSegments, layoutHeight, textWidth
+	from state import RoomStates
 import curses
 from curses import textpad
+import collections
+import itertools
 import matrix_client.room
 
 import logging
@@ -15,10 +21,185 @@ message_logger = logging.getLogger('root')
 # 	def __init__(self, size):
 # 		self.pad = curses.newpad(size)
 
+class PadPool:
+	"""
+	Pool of reusable pads, bucketed by width and number of rows.
+		Row counts are rounded up to powers of two, so each bucket serves a range of message heights.
+		Pads always have at least one more row than requested, so writing a full last line never hits the pad's last cell.
+	
+	Args:
+		bucketLimit (int, optional): Defaults to PadPool.defaultBucketLimit. Maximum number of free pads to keep per bucket
+
+	Class Attributes:
+		defaultBucketLimit (int): Default maximum number of free pads to keep per bucket
+	"""
+
+	defaultBucketLimit = 32
+
+	def __init__(self, bucketLimit:int = None):
+		if bucketLimit is None: bucketLimit = self.defaultBucketLimit
+		self.bucketLimit = bucketLimit
+		self.free = {}
+		# Structure:
+		# {(rows, width): [pad, pad...]}
+
+	@staticmethod
+	def bucketRows(height:int) -> int:
+		"""
+		Get the number of rows of the pads used for a height.
+		
+		Args:
+			height (int): Height of the content
+		
+		Returns:
+			int: Smallest power of two greater than the height
+		"""
+		return(1 << height.bit_length())
+
+	def acquire(self, height:int, width:int) -> textpad.Textbox:
+		"""
+		Get a blank pad big enough for content of a height, reusing a free one if there is one.
+		
+		Args:
+			height (int): Height of the content, in rows
+			width (int): Width of the pad
+		
+		Returns:
+			textpad.Textbox: The pad
+		"""
+
+		bucket = (self.bucketRows(height), width)
+		if self.free.get(bucket):
+			pad = self.free[bucket].pop()
+			pad.erase()
+			return(pad)
+		return(curses.newpad(*bucket))
+
+	def release(self, pad:textpad.Textbox):
+		"""
+		Return a pad to the pool. It must not be used by anything else afterwards.
+		
+		Args:
+			pad (textpad.Textbox): Pad acquired from this pool
+		"""
+
+		bucket = pad.getmaxyx()
+		free = self.free.setdefault(bucket, [])
+		if len(free) < self.bucketLimit:
+			free.append(pad)
+
+class RenderCache:
+	"""
+	Cache of rendered message pads, shared by all Messages and keyed by (render key, width).
+		Pads are kept until their total size exceeds the budget, then evicted least recently used first.
+		So a message shown at several widths keeps a pad for each, but the cache as a whole stays bounded.
+		Evicted pads are returned to the pad pool, so the budget should be well over a screenful.
+		Each render has a serial number, so a reused pad can be told apart from the render it used to hold.
+	
+	Args:
+		budget (int, optional): Defaults to RenderCache.defaultBudget. Maximum total size of cached pads, in cells (rows * columns)
+		pool (PadPool, optional): Defaults to None. Pool to return evicted pads to
+
+	Attributes:
+		budget (int): Maximum total size of cached pads, in cells
+		size (int): Current total size of cached pads, in cells
+
+	Class Attributes:
+		defaultBudget (int): Default budget, in cells
+	"""
+
+	defaultBudget = 500000
+
+	def __init__(self, budget:int = None, pool:PadPool = None):
+		if budget is None: budget = self.defaultBudget
+		self.budget = budget
+		self.pool = pool
+		self.size = 0
+		self.serials = itertools.count()
+		self.entries = collections.OrderedDict()
+		# Structure:
+		# OrderedDict((renderKey, width): (pad, lines, height, serial, version), ...)
+		# Least recently used first
+		self.widths = {}
+		# Structure:
+		# {renderKey: set(width, ...)}
+
+	def get(self, renderKey, width:int, version = None) -> tuple:
+		"""
+		Get a cached render, marking it as recently used.
+			A render made at a different version is stale, so is discarded.
+		
+		Args:
+			renderKey: Key of the rendered message, as from Message.renderKey
+			width (int): Width of the render
+			version (optional): Defaults to None. Version of whatever else the render depends on (e.g. the room's members)
+		
+		Returns:
+			tuple or None: (pad, lines, height, serial, version) if cached, else None
+		"""
+
+		rendered = self.entries.get((renderKey, width))
+		if rendered is None: return(None)
+		if rendered[4] != version:
+			self.discard(renderKey, width)
+			return(None)
+		self.entries.move_to_end((renderKey, width))
+		return(rendered)
+
+	def put(self, renderKey, width:int, pad:textpad.Textbox, lines:list, height:int, version = None) -> tuple:
+		"""
+		Cache a render, evicting the least recently used renders if over budget.
+		
+		Args:
+			renderKey: Key of the rendered message, as from Message.renderKey
+			width (int): Width of the render
+			pad (textpad.Textbox): Rendered pad
+			lines (list): Laid out lines of the render
+			height (int): Height of the render
+			version (optional): Defaults to None. Version of whatever else the render depends on, as for get
+
+		Returns:
+			tuple: (pad, lines, height, serial, version), as cached
+		"""
+
+		self.discard(renderKey, width)
+		rendered = (pad, lines, height, next(self.serials), version)
+		self.entries[(renderKey, width)] = rendered
+		self.widths.setdefault(renderKey, set()).add(width)
+		self.size += self._cells(pad)
+		while self.size > self.budget and len(self.entries) > 1:
+			(evictedKey, evictedWidth), _ = next(iter(self.entries.items()))
+			self.discard(evictedKey, evictedWidth)
+		return(rendered)
+
+	def discard(self, renderKey, width:int = None):
+		"""
+		Remove renders of a message from the cache, e.g. when it changes.
+		
+		Args:
+			renderKey: Key of the rendered message, as from Message.renderKey
+			width (int, optional): Defaults to None. Width of the render to remove. If None, renders at all widths are removed.
+		"""
+
+		widths = self.widths.get(renderKey, set())
+		for discardWidth in ([width] if width is not None else list(widths)):
+			rendered = self.entries.pop((renderKey, discardWidth), None)
+			if rendered is None: continue
+			self.size -= self._cells(rendered[0])
+			widths.discard(discardWidth)
+			if self.pool is not None: self.pool.release(rendered[0])
+		if not widths: self.widths.pop(renderKey, None)
+
+	@staticmethod
+	def _cells(pad:textpad.Textbox) -> int:
+		height, width = pad.getmaxyx()
+		return(height * width)
+
 class Message:#(ChatObject):
 	"""
 	Base class for messages in the chat.
-		Message types should extend this, overloading Message.constructPad and Message.checkEventType
+		Message types should extend this, overloading Message.constructPad and Message.structure
+		Message.checkEventType should only be overloaded for checks a structure can't express
 	
 	Args:
 		event (dict): Event to construct from
@@ -26,18 +207,38 @@ class Message:#(ChatObject):
 
 	Attributes:
 		event (dict): Event the message is constructed from
-		pad (textpad.Textbox): Textpad for the message
+		segments (list): (text, attr) segments of the message, as added by constructPad
+		lines (list): The segments laid out to the current width, as from layout.layoutSegments
+		pad (textpad.Textbox): Textpad for the message. Sized to the message's height, and owned by the renderCache
 		width (int): Width of the pad
-		height (int): Height of the pad
+		height (int): Height of the message's text, in lines. 0 if it has no visible text.
+		renderSerial (int): Serial number of the current render, from the renderCache
+		membersVersion (int): The room's RoomState.membersVersion when the segments were constructed
 
 	Class Attributes:
 		MAXLEN (int): Max length, in characters, of messages
 		senderColour (int): Default colour of Senders
 		tsColour (int): Default colour of timestamps
 		contentColour (int): Default colour of content
+		structure (dict): Structure an event must match to use this class (see utils.checkStructure)
+			Only the fields specific to this class are needed; parent classes are checked first
+		matchesStructure (callable): Predicate compiled from structure when the class is defined
+		padPool (PadPool): Pool of pads, sized to content, shared by all Messages
+		renderCache (RenderCache): Cache of rendered pads shared by all Messages
+		sendStatusKey (str): Key in an event's unsigned data of the send status of a local echo, shown after the message
 	"""
 
 	MAXLEN = 1024 # Maximum length, in characters, of the message
+	structure = {}
+	matchesStructure = staticmethod(compileStructure(structure))
+	padPool = PadPool()
+	renderCache = RenderCache(pool=padPool)
+	sendStatusKey = 'nutmeg.send_status'
+
+	def __init_subclass__(cls, **kwargs):
+		super().__init_subclass__(**kwargs)
+		# Compile each class's structure once, rather than on every checkEventType call
+		cls.matchesStructure = staticmethod(compileStructure(cls.structure))
 
 	def __init__(self, event:dict, room:matrix_client.room.Room):
 		self.senderColour = curses.A_NORMAL
@@ -46,11 +247,27 @@ class Message:#(ChatObject):
 
 		self.room = room
 		self.event = event
+		self.segments = None
+		self.membersVersion = None
 		self.width = None
 
+	@property
+	def renderKey(self):
+		"""
+		Key identifying this message's renders in the renderCache.
+			The event ID, or for events without one (e.g. Nutmeg output), the identity of the event.
+		"""
+		if 'event_id' in self.event: return(self.event['event_id'])
+		return(('local', id(self.event)))
+
 	def build(self, width:int) -> textpad.Textbox:
 		"""
 		Build the message's textpad.
+			The message is laid out first, so self.height is known without inspecting the pad,
+			and the pad is taken from the padPool at the size the content needs.
+			Renders are shared through the renderCache, so a render at a width is reused until evicted,
+			or until the room's members change, as senders' names may have.
+			Evicted pads are reused for other messages, so the pad should only be used until the next build.
 		
 		Args:
 			width (int): Width of the pad to build
@@ -59,21 +276,72 @@ class Message:#(ChatObject):
 			textpad.Textbox: Textpad of the message.
 				You should call textpad.refresh on this (or on self.pad later)
 		"""
-		if self.width != width:
-			self.width = width
-			self.height = self.MAXLEN // width + 1
-			self.pad = curses.newpad(self.height, self.width)
+		membersVersion = RoomStates.get(self.room).membersVersion
+		if membersVersion != self.membersVersion:
+			self.segments = None
+			self.membersVersion = membersVersion
+		rendered = self.renderCache.get(self.renderKey, width, version=membersVersion)
+		if rendered is None:
+			self.layout(width)
+			pad = self.padPool.acquire(self.height, width)
+			self.drawLines(pad)
+			rendered = self.renderCache.put(self.renderKey, width, pad, self.lines, self.height, version=membersVersion)
+		self.width = width
+		self.pad, self.lines, self.height, self.renderSerial, _ = rendered
+		return(self.pad)
+
+	def getSegments(self) -> list:
+		"""
+		Get the message's text segments, constructing them on first use.
+		
+		Returns:
+			list: (text, attr) segments of the message
+		"""
+		if self.segments is None:
+			self.segments = []
 			try:
 				self.constructPad()
 			except Exception as e:
 				message_logger.error('Error in constructPad: '+str(e)+'; Event being built: '+str(self.event))
-		return(self.pad)
+			sendStatus = self.event.get('unsigned', {}).get(self.sendStatusKey)
+			if sendStatus is not None:
+				self.printGeneric(' (%(status)s)' % {'status': sendStatus}, colour=self.tsColour)
+		return(self.segments)
 
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
+	def layout(self, width:int) -> int:
+		"""
+		Lay out the message's text to a width, without touching curses.
+			Sets self.lines and self.height.
+		
+		Args:
+			width (int): Width to lay out to
+		
+		Returns:
+			int: Height of the message, in lines
+		"""
+		self.lines = layoutSegments(self.getSegments(), width)
+		self.height = min(layoutHeight(self.lines), self.MAXLEN // width + 1)
+		return(self.height)
+
+	def drawLines(self, pad:textpad.Textbox):
+		"""
+		Write the message's laid out lines to a pad.
+		
+		Args:
+			pad (textpad.Textbox): Pad to write to. Should be at least as wide as the layout, and taller than self.height
+		"""
+		for y in range(self.height):
+			x = 0
+			for text, attr in self.lines[y]:
+				pad.addstr(y, x, text, attr)
+				x += textWidth(text)
+
+	@classmethod
+	def checkEventType(cls, event:dict) -> bool:
 		"""
 		Check if an event has the correct properties for this class.
 			Used in determining which subclass of Message to use for printing a message.
+			By default this checks the event against cls.structure.
 		
 		Args:
 			event (dict): Event to check
@@ -82,11 +350,11 @@ class Message:#(ChatObject):
 			bool: Whether this is an appropriate subclass to use in printing the message.
 		"""
 		
-		return(True)
+		return(cls.matchesStructure(event))
 
 	def constructPad(self):
 		"""
-		Do event-type specific construction here.
+		Do event-type specific construction here, adding the message's text with printGeneric etc.
 			Most message types should overload this.
 		"""
 
@@ -95,67 +363,63 @@ class Message:#(ChatObject):
 		message_logger.warn(message)
 		self.printGeneric(message, colour = curses.COLOR_RED)
 
-	def printGeneric(self, text:str, pad:textpad.Textbox = None, colour:int = None) -> textpad.Textbox:
+	def printGeneric(self, text:str, segments:list = None, colour:int = None) -> list:
 		"""
 		Print generic text to the message.
 
 		Args:
 			text (str): Text to be written
-			pad (textpad.Textbox, optional): Defaults to self.pad. The pad to write to.
+			segments (list, optional): Defaults to self.segments. The segments to add to.
 			colour (int, optional): Defaults to self.contentColour. The colour to write in.
 
 		Returns:
-			textpad.Textbox: The pad written to.
+			list: The segments added to.
 		"""
 
 		if colour is None: colour = self.contentColour
-		if pad is None: pad = self.pad
-		pad.addstr(str(text), colour)
-		return(pad)
+		if segments is None: segments = self.segments
+		segments.append((str(text), colour))
+		return(segments)
 
-	def printSender(self, pad:textpad.Textbox = None, colour:int = None, append:str = None) -> textpad.Textbox:
+	def printSender(self, segments:list = None, colour:int = None, append:str = None) -> list:
 		"""
 		Add a Sender to the message.
 
 		Args:
-			pad (textpad.Textbox, optional): Defaults to self.pad. The pad to write to.
+			segments (list, optional): Defaults to self.segments. The segments to add to.
 			colour (int, optional): Defaults to self.senderColour. The colour to write in.
-			append (str, optional): Defaults to None. If supplied, appends the string to the pad in the same colour.
+			append (str, optional): Defaults to None. If supplied, appends the string to the segments in the same colour.
 
 		Returns:
-			textpad.Textbox: The pad written to.
+			list: The segments added to.
 		"""
 		
 		if colour is None: colour = self.senderColour
-		if pad is None: pad = self.pad
-		try:
-			sender = getMember(self.room, self.event['sender']).displayname
-		except Exception as e:
-			message_logger.error('Exception in printSender: '+str(e))
-			sender = self.event['sender']
+		if segments is None: segments = self.segments
+		sender = RoomStates.get(self.room).getDisplayName(self.event['sender'])
 		if append is not None: sender += append
-		pad.addstr(sender, colour)
-		return(pad)
+		segments.append((sender, colour))
+		return(segments)
 
-	def printOriginTs(self, pad:textpad.Textbox = None, colour:int = None, append:str = None) -> textpad.Textbox:
+	def printOriginTs(self, segments:list = None, colour:int = None, append:str = None) -> list:
 		"""
 		Add a timestamp to the message (origin server timestamp).
 
 		Args:
-			pad (textpad.Textbox, optional): Defaults to self.pad. The pad to write to.
+			segments (list, optional): Defaults to self.segments. The segments to add to.
 			colour (int, optional): Defaults to self.tsColour. The colour to write in.
-			append (str, optional): Defaults to None. If supplied, appends the string to the pad in the same colour.
+			append (str, optional): Defaults to None. If supplied, appends the string to the segments in the same colour.
 
 		Returns:
-			textpad.Textbox: The pad written to.
+			list: The segments added to.
 		"""
 
 		if colour is None: colour = self.tsColour
-		if pad is None: pad = self.pad
+		if segments is None: segments = self.segments
 		ts = tsToDt(str(self.event['origin_server_ts']))
 		if append is not None: ts += append
-		pad.addstr(ts, colour)
-		return(pad)
+		segments.append((ts, colour))
+		return(segments)
 
 class Event(Message):
 	"""
@@ -165,13 +429,10 @@ class Event(Message):
 		Client-Server API: 9 Events
 		https://matrix.org/docs/spec/client_server/r0.5.0#id276
 	"""
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'type': str,
-			'content': {}
-		}
-		return(checkStructure(event, structure))
+	structure = {
+		'type': str,
+		'content': {}
+	}
 
 class NutmegEvent(Event):
 	"""
@@ -183,14 +444,11 @@ class NutmegEvent(Event):
 		'source': 'Nutmeg'
 		'content': dict
 	"""
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'type': str,
-			'source': 'Nutmeg',
-			'content': {}
-		}
-		return(checkStructure(event, structure))
+	structure = {
+		'type': str,
+		'source': 'Nutmeg',
+		'content': {}
+	}
 
 	def constructPad(self):
 		"""
@@ -214,16 +472,13 @@ class NutmegCommandOutput(NutmegEvent):
 	Output style:
 		Command: Message
 	"""
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'type': 'n.output.command',
-			'content': {
-				'command': str,
-				'message': str
-			}
+	structure = {
+		'type': 'n.output.command',
+		'content': {
+			'command': str,
+			'message': str
 		}
-		return(checkStructure(event, structure))
+	}
 
 	def constructPad(self):
 		self.printGeneric(self.event['content']['command'] + ': ', colour=self.senderColour)
@@ -241,16 +496,13 @@ class NutmegCommandHelp(NutmegEvent):
 	Output style:
 		Command: Message
 	"""
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'type': 'n.output.help',
-			'content': {
-				'command': str,
-				'message': str
-			}
+	structure = {
+		'type': 'n.output.help',
+		'content': {
+			'command': str,
+			'message': str
 		}
-		return(checkStructure(event, structure))
+	}
 
 	def constructPad(self):
 		self.printGeneric(self.event['content']['command'] + ': ', colour=self.senderColour)
@@ -268,16 +520,13 @@ class NutmegCommandError(NutmegEvent):
 	Output style:
 		Command: Message
 	"""
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'type': 'n.output.error',
-			'content': {
-				'command': str,
-				'message': str
-			}
+	structure = {
+		'type': 'n.output.error',
+		'content': {
+			'command': str,
+			'message': str
 		}
-		return(checkStructure(event, structure))
+	}
 
 	def constructPad(self):
 		self.printGeneric(self.event['content']['command'] + ': ', colour=self.senderColour)
@@ -289,16 +538,13 @@ class RoomEvent(Event):
 		Client-Server API: 9.1.2 Room Event Fields
 		https://matrix.org/docs/spec/client_server/r0.5.0#id279
 	"""
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'event_id': str,
-			'sender': str,
-			'origin_server_ts': int
-		}
-		# Note that required field room_id is NOT checked
-		# This is because events received through /sync do not include this field
-		return(checkStructure(event, structure))
+	structure = {
+		'event_id': str,
+		'sender': str,
+		'origin_server_ts': int
+	}
+	# Note that required field room_id is NOT checked
+	# This is because events received through /sync do not include this field
 
 class StateEvent(RoomEvent):
 	"""
@@ -306,12 +552,9 @@ class StateEvent(RoomEvent):
 		Client-Server API: 9.1.3 State Event Fields
 		https://matrix.org/docs/spec/client_server/r0.5.0#id280
 	"""
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'state_key': str
-		}
-		return(checkStructure(event, structure))
+	structure = {
+		'state_key': str
+	}
 
 class RoomAliases(StateEvent):
 	"""
@@ -325,15 +568,12 @@ class RoomAliases(StateEvent):
 	Output style:
 		None
 	"""
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'type': 'm.room.aliases',
-			'content': {
-				'aliases': list
-			}
+	structure = {
+		'type': 'm.room.aliases',
+		'content': {
+			'aliases': list
 		}
-		return(checkStructure(event, structure))
+	}
 
 	def constructPad(self): pass
 
@@ -346,15 +586,12 @@ class CanonicalAlias(StateEvent):
 	Output style:
 		Timestamp - Sender changed the room's canonical alias to Alias
 	"""
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'type': 'm.room.canonical_alias',
-			'content': {
-				'alias': str
-			}
+	structure = {
+		'type': 'm.room.canonical_alias',
+		'content': {
+			'alias': str
 		}
-		return(checkStructure(event, structure))
+	}
 	
 	def constructPad(self):
 		message = ('changed the room\'s canonical alias to %(alias)s.' %
@@ -372,15 +609,12 @@ class RoomCreate(StateEvent):
 	Output style:
 		Timestamp - Sender created the room.
 	"""
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'type': 'm.room.create',
-			'content': {
-				'creator': str
-			}
+	structure = {
+		'type': 'm.room.create',
+		'content': {
+			'creator': str
 		}
-		return(checkStructure(event, structure))
+	}
 	
 	def constructPad(self):
 		self.printOriginTs(append=' - ')
@@ -403,15 +637,16 @@ class JoinRules(StateEvent):
 	'knock': 'unknown',
 	'private': 'private'}
 
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'type': 'm.room.join_rules',
-			'content': {
-				'join_rule': str
-			}
+	structure = {
+		'type': 'm.room.join_rules',
+		'content': {
+			'join_rule': str
 		}
-		return(checkStructure(event, structure) and event['content']['join_rule'] in JoinRules.joinTypes)
+	}
+
+	@classmethod
+	def checkEventType(cls, event:dict) -> bool:
+		return(cls.matchesStructure(event) and event['content']['join_rule'] in cls.joinTypes)
 
 	
 	def constructPad(self):
@@ -433,18 +668,19 @@ class RoomMember(StateEvent):
 
 	membershipTypes = ['invite', 'join', 'ban', 'leave', 'knock']
 
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'type': 'm.room.member',
-			'content': {
-				'membership': str
-			}
+	structure = {
+		'type': 'm.room.member',
+		'content': {
+			'membership': str
 		}
-		return(checkStructure(event, structure) and event['content']['membership'] in RoomMember.membershipTypes)
+	}
+
+	@classmethod
+	def checkEventType(cls, event:dict) -> bool:
+		return(cls.matchesStructure(event) and event['content']['membership'] in cls.membershipTypes)
 	
 	def constructPad(self):
-		stateKeyName = getMember(self.room, self.event['state_key']).displayname
+		stateKeyName = RoomStates.get(self.room).getDisplayName(self.event['state_key'])
 		message = ('changed %(stateKeyName)s\'s membership status to %(membership)s.' %
 			{'stateKeyName': stateKeyName, 
 			'membership':str(self.event['content']['membership'])})
@@ -466,14 +702,11 @@ class MemberJoin(RoomMember):
 		Timestamp - Sender changed their avatar.
 	"""
 
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'content': {
-				'membership': 'join'
-			}
+	structure = {
+		'content': {
+			'membership': 'join'
 		}
-		return(checkStructure(event, structure))
+	}
 	
 	def constructPad(self):
 		self.printOriginTs(append=' - ')
@@ -501,14 +734,11 @@ class MemberInvite(RoomMember):
 		Timestamp - Sender invited State_Key to the room.
 	"""
 
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'content': {
-				'membership': 'invite'
-			}
+	structure = {
+		'content': {
+			'membership': 'invite'
 		}
-		return(checkStructure(event, structure))
+	}
 	
 	def constructPad(self):
 		if 'prev_content' in self.event and self.event['prev_content']['membership'] == 'invite': return
@@ -531,14 +761,11 @@ class MemberLeave(RoomMember):
 		Timestamp - State_Key left the room.
 	"""
 
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'content': {
-				'membership': 'leave'
-			}
+	structure = {
+		'content': {
+			'membership': 'leave'
 		}
-		return(checkStructure(event, structure))
+	}
 	
 	def constructPad(self):
 		message = ('%(stateKey)s left the room.' %
@@ -558,14 +785,11 @@ class MemberLeaveToLeave(MemberLeave):
 		None
 	"""
 
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'prev_content': {
-				'membership': 'leave'
-			}
+	structure = {
+		'prev_content': {
+			'membership': 'leave'
 		}
-		return(checkStructure(event, structure))
+	}
 	
 	def constructPad(self): pass
 
@@ -581,14 +805,11 @@ class MemberUnban(MemberLeave):
 		Timestamp - Sender unbanned State_Key.
 	"""
 
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'prev_content': {
-				'membership': 'ban'
-			}
+	structure = {
+		'prev_content': {
+			'membership': 'ban'
 		}
-		return(checkStructure(event, structure))
+	}
 	
 	def constructPad(self):
 		message = ('unbanned %(stateKey)s.' %
@@ -609,14 +830,11 @@ class MemberUninvite(MemberLeave):
 		Timestamp - Sender rescinded the invitation to State_Key.
 	"""
 
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'prev_content': {
-				'membership': 'invite'
-			}
+	structure = {
+		'prev_content': {
+			'membership': 'invite'
 		}
-		return(checkStructure(event, structure))
+	}
 	
 	def constructPad(self):
 		message = ('rescinded the invitation to %(stateKey)s.' %
@@ -637,15 +855,16 @@ class MemberKicked(MemberLeave):
 		Timestamp - Sender kicked State_Key.
 	"""
 
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'prev_content': {
-				'membership': 'join'
-			}
+	structure = {
+		'prev_content': {
+			'membership': 'join'
 		}
+	}
+
+	@classmethod
+	def checkEventType(cls, event:dict) -> bool:
 		if event['state_key'] == event['sender']: return(False)
-		return(checkStructure(event, structure))
+		return(cls.matchesStructure(event))
 	
 	def constructPad(self):
 		message = ('kicked %(stateKey)s.' %
@@ -666,14 +885,11 @@ class MemberBan(RoomMember):
 		Timestamp - Sender banned State_Key.
 	"""
 
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'content': {
-				'membership': 'ban'
-			}
+	structure = {
+		'content': {
+			'membership': 'ban'
 		}
-		return(checkStructure(event, structure))
+	}
 	
 	def constructPad(self):
 		message = ('banned %(stateKey)s' %
@@ -693,14 +909,11 @@ class MemberKickBan(MemberBan):
 		Timestamp - Sender kicked and banned State_Key.
 	"""
 
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'prev_content': {
-				'membership': 'join'
-			}
+	structure = {
+		'prev_content': {
+			'membership': 'join'
 		}
-		return(checkStructure(event, structure))
+	}
 	
 	def constructPad(self):
 		message = ('kicked and banned %(stateKey)s' %
@@ -718,12 +931,9 @@ class PowerLevels(StateEvent):
 		Timestamp - Sender changed the room's power levels.
 	"""
 	# TODO: Consider adding more info here
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'type': 'm.room.power_levels'
-		}
-		return(checkStructure(event, structure))
+	structure = {
+		'type': 'm.room.power_levels'
+	}
 	
 	def constructPad(self):
 		self.printOriginTs(append=' - ')
@@ -740,13 +950,10 @@ class RoomRedaction(RoomEvent):
 		Timestamp - Sender redacted event Event_Id for reason: Reason.
 	"""
 	# TODO: Consider adding more info here
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'type': 'm.room.redaction',
-			'redacts': str
-		}
-		return(checkStructure(event, structure))
+	structure = {
+		'type': 'm.room.redaction',
+		'redacts': str
+	}
 	
 	def constructPad(self):
 		if 'content' in self.event and 'reason' in self.event['content']:
@@ -767,16 +974,13 @@ class RedactedEvent(RoomEvent):
 	Output style:
 		Timestamp - Sender: [REDACTED BY EVENT Redacted_By]
 	"""
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'unsigned': {
-				'redacted_because': {
-					'event_id': str
-				}
+	structure = {
+		'unsigned': {
+			'redacted_because': {
+				'event_id': str
 			}
 		}
-		return(checkStructure(event, structure))
+	}
 	
 	def constructPad(self):
 		self.printOriginTs(append=' - ')
@@ -792,15 +996,12 @@ class RoomName(StateEvent):
 	Output style:
 		Timestamp - Sender changed the room name to Name
 	"""
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'type': 'm.room.name',
-			'content': {
-				'name': str
-			}
+	structure = {
+		'type': 'm.room.name',
+		'content': {
+			'name': str
 		}
-		return(checkStructure(event, structure))
+	}
 	
 	def constructPad(self):
 		message = ('changed the room name to %(name)s.' %
@@ -818,15 +1019,12 @@ class RoomTopic(StateEvent):
 	Output style:
 		Timestamp - Sender changed the room's topic to Topic
 	"""
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'type': 'm.room.topic',
-			'content': {
-				'topic': str
-			}
+	structure = {
+		'type': 'm.room.topic',
+		'content': {
+			'topic': str
 		}
-		return(checkStructure(event, structure))
+	}
 	
 	def constructPad(self):
 		message = ('changed the room\'s topic to %(topic)s.' %
@@ -847,16 +1045,13 @@ class RoomMessage(RoomEvent):
 	Output style:
 		Timestamp - Sender: Text
 	"""
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'type': 'm.room.message',
-			'content': {
-				'body': str,
-				'msgtype': str
-			}
+	structure = {
+		'type': 'm.room.message',
+		'content': {
+			'body': str,
+			'msgtype': str
 		}
-		return(checkStructure(event, structure))
+	}
 	
 	def constructPad(self):
 		"""
@@ -873,14 +1068,11 @@ class TextMessage(RoomMessage):
 		https://matrix.org/docs/spec/client_server/r0.5.0#id369
 	"""
 
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'content': {
-				'msgtype': 'm.text'
-			}
+	structure = {
+		'content': {
+			'msgtype': 'm.text'
 		}
-		return(checkStructure(event, structure))
+	}
 
 class EmoteMessage(RoomMessage):
 	"""
@@ -892,14 +1084,11 @@ class EmoteMessage(RoomMessage):
 		Timestamp * Sender Text
 	"""
 
-	@staticmethod
-	def checkEventType(event:dict) -> bool:
-		structure = {
-			'content': {
-				'msgtype': 'm.emote'
-			}
+	structure = {
+		'content': {
+			'msgtype': 'm.emote'
 		}
-		return(checkStructure(event, structure))
+	}
 	
 	def constructPad(self):
 		self.printOriginTs(append=' * ')
@@ -911,15 +1100,29 @@ class MessageBuilder:
 	"""
 	Container method for building generic events into Messages.
 		Only MessageBuilder.initMessage should usually be used.
+
+	Class Attributes:
+		messageTypeTree (dict): Tree of Message and all its subclasses, as from utils.buildTypeTree
+		dispatchFields (tuple): Paths into an event whose values discriminate between Message classes
+		dispatchIndex (tuple or dict): Precompiled index over dispatchFields, built once at import
+			See MessageBuilder._compileDispatch for its structure
 	"""
 
 	messageTypeTree = {Message: buildTypeTree(Message)}
+	dispatchFields = (
+		('type',),
+		('source',),
+		('content', 'msgtype'),
+		('content', 'membership'),
+		('prev_content', 'membership'),
+	)
+	dispatchIndex = None # Compiled after the class is defined
 
 	@staticmethod
 	def initMessage(event:dict, room:matrix_client.room.Room) -> Message:
 		"""
 		Initialize a Message of the appropriate class from an event and a room.
-			Checks each subclass of Message to see if that subclass is the appropriate type for that event.
+			Selects the most specific subclass of Message applicable to the event.
 			If none are, defaults to base Message class.
 		
 		Args:
@@ -934,12 +1137,50 @@ class MessageBuilder:
 		message_logger.debug('Building message for event: %(event)s' %
 			{'event': str(event)})
 
-		messageType = MessageBuilder._selectInTypeTree(MessageBuilder.messageTypeTree, event)
+		messageType = MessageBuilder.selectMessageType(event)
 		message_logger.debug('Using messageType: %(messageType)s' %
 			{'messageType': str(messageType)})
-		if messageType is None: raise ValueError('MessageBuilder._selectInTypeTree returned None. This should never happen.')
+		if messageType is None: raise ValueError('MessageBuilder.selectMessageType returned None. This should never happen.')
 		return(messageType(event, room))
 
+	@staticmethod
+	def eventTypes() -> list:
+		"""
+		Get the Matrix event types which some Message class handles, e.g. to filter out every other type.
+			Nutmeg's own output types (n.*) aren't included.
+		
+		Returns:
+			list: Event types, in tree order
+		"""
+
+		return([eventType for eventType in MessageBuilder._requiredValues(MessageBuilder.messageTypeTree, ('type',))
+			if not eventType.startswith('n.')])
+
+	@staticmethod
+	def selectMessageType(event:dict) -> type:
+		"""
+		Find the most specific Message class applicable to an event.
+			Looks the event up in the dispatchIndex to get a pruned type tree, then walks that.
+			Gives the same result as walking the full messageTypeTree, but only checks classes that can still match.
+		
+		Args:
+			event (dict): Event to classify
+		
+		Returns:
+			type or None: The applicable Message class
+		"""
+
+		node = MessageBuilder.dispatchIndex
+		while isinstance(node, tuple):
+			path, branches, default = node
+			value = MessageBuilder._lookupPath(event, path)
+			try:
+				node = branches.get(value, default)
+			except TypeError:
+				# Unhashable values can't be equal to any of our constants
+				node = default
+		return(MessageBuilder._selectInTypeTree(node, event))
+
 	@staticmethod
 	def _selectInTypeTree(typeTree:dict, event:dict):
 		"""
@@ -948,8 +1189,8 @@ class MessageBuilder:
 			So make sure to keep classes hierarchical 
 		
 		Args:
-			typeTree (dict): [description]
-			event (dict): [description]
+			typeTree (dict): Type tree (or pruned type tree) to search
+			event (dict): Event to find a class for
 
 		Returns:
 			type or None: The subclass in the typeTree that is applicable
@@ -968,3 +1209,105 @@ class MessageBuilder:
 						return(cls)
 		return(None)
 
+	@staticmethod
+	def _lookupPath(item:dict, path:tuple):
+		"""
+		Get the value at a path of keys in nested dicts.
+		
+		Args:
+			item (dict): Dict to look in
+			path (tuple): Keys to follow, outermost first
+		
+		Returns:
+			The value found, or None if the path doesn't exist
+		"""
+
+		for key in path:
+			if not isinstance(item, dict) or key not in item: return(None)
+			item = item[key]
+		return(item)
+
+	@staticmethod
+	def _requiredValue(cls:type, path:tuple):
+		"""
+		Get the constant value a class's structure requires at a path, if any.
+		
+		Args:
+			cls (type): Message class to check
+			path (tuple): Path into the event
+		
+		Returns:
+			The required value, or None if the class's structure doesn't require a constant there
+		"""
+
+		value = MessageBuilder._lookupPath(cls.structure, path)
+		if value is None or isinstance(value, (type, dict)): return(None)
+		return(value)
+
+	@staticmethod
+	def _requiredValues(typeTree:dict, path:tuple) -> list:
+		"""
+		Get every constant value required at a path by any class in a type tree.
+		
+		Args:
+			typeTree (dict): Type tree to check
+			path (tuple): Path into the event
+		
+		Returns:
+			list: Required values, in tree order, without duplicates
+		"""
+
+		values = []
+		for cls in typeTree:
+			value = MessageBuilder._requiredValue(cls, path)
+			if value is not None and value not in values: values.append(value)
+			for value in MessageBuilder._requiredValues(typeTree[cls], path):
+				if value not in values: values.append(value)
+		return(values)
+
+	@staticmethod
+	def _pruneTypeTree(typeTree:dict, path:tuple, value) -> dict:
+		"""
+		Remove classes (and their subclasses) which can't match an event with a given value at a path.
+			Order is preserved, so walking the pruned tree selects the same class as walking the full one.
+		
+		Args:
+			typeTree (dict): Type tree to prune
+			path (tuple): Path into the event
+			value: The event's value at the path. None means missing, or not required by any class
+		
+		Returns:
+			dict: Pruned type tree
+		"""
+
+		pruned = {}
+		for cls in typeTree:
+			required = MessageBuilder._requiredValue(cls, path)
+			if required is not None and required != value: continue
+			pruned[cls] = MessageBuilder._pruneTypeTree(typeTree[cls], path, value)
+		return(pruned)
+
+	@staticmethod
+	def _compileDispatch(typeTree:dict, fields:tuple):
+		"""
+		Compile a type tree into a dispatch index.
+		
+		Args:
+			typeTree (dict): Type tree to compile
+			fields (tuple): Paths into the event to dispatch on, in order
+		
+		Returns:
+			tuple or dict: Either a type tree, if no fields discriminate between its classes, or
+				(path, {value: index}, defaultIndex), where each index is compiled from the remaining fields
+		"""
+
+		for i, path in enumerate(fields):
+			values = MessageBuilder._requiredValues(typeTree, path)
+			if not values: continue
+			branches = {value: MessageBuilder._compileDispatch(MessageBuilder._pruneTypeTree(typeTree, path, value), fields[i+1:])
+				for value in values}
+			default = MessageBuilder._compileDispatch(MessageBuilder._pruneTypeTree(typeTree, path, None), fields[i+1:])
+			return((path, branches, default))
+		return(typeTree)
+
+MessageBuilder.dispatchIndex = MessageBuilder._compileDispatch(MessageBuilder.messageTypeTree, MessageBuilder.dispatchFields)
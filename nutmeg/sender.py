@@ -0,0 +1,198 @@
+"""
+Sending events to the homeserver in the background, with retries.
+"""
+
+import collections
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+from matrix_client.errors import MatrixRequestError
+
+import logging
+sender_logger = logging.getLogger('root')
+
+def backoffDelay(attempt:int, base:float = 0.5, cap:float = 60) -> float:
+	"""
+	Get how long to wait before retrying, using exponential backoff with full jitter.
+		Jitter spreads out retries from many clients (or many messages) failing at once.
+
+	Args:
+		attempt (int): Number of attempts which have failed so far, from 1
+		base (float, optional): Defaults to 0.5. Maximum delay after the first failure, in seconds
+		cap (float, optional): Defaults to 60. Maximum delay, in seconds
+
+	Returns:
+		float: Delay in seconds
+	"""
+
+	return(random.uniform(0, min(cap, base * 2 ** (attempt - 1))))
+
+def retryAfter(error:Exception) -> float:
+	"""
+	Get how long a rate-limited request asked us to wait.
+
+	Args:
+		error (Exception): Error from a request
+
+	Returns:
+		float or None: Seconds to wait, or None if the error isn't a rate limit (HTTP 429) with retry_after_ms
+	"""
+
+	if not isinstance(error, MatrixRequestError) or error.code != 429: return(None)
+	try:
+		return(json.loads(error.content)['retry_after_ms'] / 1000)
+	except (ValueError, KeyError, TypeError):
+		return(None)
+
+def isPermanent(error:Exception) -> bool:
+	"""
+	Check whether a failed request would fail the same way if retried.
+
+	Args:
+		error (Exception): Error from a request
+
+	Returns:
+		bool: True for client errors (HTTP 4xx) other than rate limits; False for server and connection errors
+	"""
+
+	return(isinstance(error, MatrixRequestError) and 400 <= error.code < 500 and error.code != 429)
+
+class OutboundEvent:
+	"""
+	An event waiting to be sent, and how sending it is going.
+
+	Args:
+		room (matrix_client.room.Room): Room to send to
+		eventType (str): Type of the event
+		content (dict): Content of the event
+		transactionId (str): Transaction ID to send it with. Reused on retries, so the homeserver won't duplicate it.
+
+	Attributes:
+		status (str): One of OutboundEvent.QUEUED, SENDING, RETRYING, SENT or FAILED
+		attempts (int): Number of attempts made to send it
+		eventId (str or None): Event ID the homeserver gave it, once sent
+		error (Exception or None): The last error sending it
+	"""
+
+	QUEUED = 'queued'
+	SENDING = 'sending'
+	RETRYING = 'retrying'
+	SENT = 'sent'
+	FAILED = 'failed'
+
+	def __init__(self, room, eventType:str, content:dict, transactionId:str):
+		self.room = room
+		self.eventType = eventType
+		self.content = content
+		self.transactionId = transactionId
+		self.status = self.QUEUED
+		self.attempts = 0
+		self.eventId = None
+		self.error = None
+
+class SendQueue:
+	"""
+	Sends events on background worker threads.
+		Each room's events are sent one at a time, in the order they were queued; different rooms are sent in parallel.
+		Failed sends are retried with exponential backoff and jitter, waiting as long as rate limits ask,
+		and the room's later events wait behind them. Events fail for good on client errors or after maxAttempts.
+
+	Args:
+		api (matrix_client.api.MatrixHttpApi): API to send with
+		statusHandler (callable): Called with each OutboundEvent whenever its status changes. Called from worker threads.
+		workerCount (int, optional): Defaults to SendQueue.defaultWorkerCount. Number of worker threads
+
+	Class Attributes:
+		defaultWorkerCount (int): Default number of worker threads
+		maxAttempts (int): Number of attempts to make before giving up on an event
+	"""
+
+	defaultWorkerCount = 2
+	maxAttempts = 8
+
+	def __init__(self, api, statusHandler:callable, workerCount:int = None):
+		if workerCount is None: workerCount = self.defaultWorkerCount
+		self.api = api
+		self.statusHandler = statusHandler
+		self.rooms = {}
+		# Structure:
+		# {'room_id': deque(OutboundEvent, ...)}
+		# Events waiting in each room, oldest first. The first is being sent, or waiting to be retried.
+		self.ready = []
+		# Heap of (time, n, 'room_id'): rooms whose first event can be sent from the time
+		self.order = itertools.count()
+		self.condition = threading.Condition()
+		self.workers = [threading.Thread(target=self._worker, name='sender', daemon=True) for _ in range(workerCount)]
+		for worker in self.workers: worker.start()
+
+	def put(self, room, eventType:str, content:dict, transactionId:str) -> OutboundEvent:
+		"""
+		Queue an event to be sent, after any events already queued in the room.
+
+		Args:
+			room (matrix_client.room.Room): Room to send to
+			eventType (str): Type of the event
+			content (dict): Content of the event
+			transactionId (str): Transaction ID to send it with
+
+		Returns:
+			OutboundEvent: The queued event
+		"""
+
+		outbound = OutboundEvent(room, eventType, content, transactionId)
+		with self.condition:
+			if room.room_id not in self.rooms:
+				self.rooms[room.room_id] = collections.deque()
+				self._schedule(room.room_id, time.monotonic())
+			self.rooms[room.room_id].append(outbound)
+		return(outbound)
+
+	def _schedule(self, roomId:str, when:float):
+		# Must be called holding the condition
+		heapq.heappush(self.ready, (when, next(self.order), roomId))
+		self.condition.notify()
+
+	def _worker(self):
+		while True:
+			with self.condition:
+				while not self.ready or self.ready[0][0] > time.monotonic():
+					self.condition.wait(timeout=self.ready[0][0] - time.monotonic() if self.ready else None)
+				_, _, roomId = heapq.heappop(self.ready)
+				outbound = self.rooms[roomId][0]
+
+			outbound.attempts += 1
+			outbound.status = OutboundEvent.SENDING
+			self.statusHandler(outbound)
+			try:
+				response = self.api.send_message_event(outbound.room.room_id, outbound.eventType, outbound.content,
+					txn_id=outbound.transactionId)
+				outbound.eventId = response['event_id']
+				outbound.status = OutboundEvent.SENT
+				delay = None
+			except Exception as e:
+				outbound.error = e
+				if isPermanent(e) or outbound.attempts >= self.maxAttempts:
+					outbound.status = OutboundEvent.FAILED
+					delay = None
+				else:
+					outbound.status = OutboundEvent.RETRYING
+					delay = retryAfter(e)
+					if delay is None: delay = backoffDelay(outbound.attempts)
+				sender_logger.error('Exception while sending to room %(roomId)s (attempt %(attempt)d): %(error)s' %
+					{'roomId': roomId,
+					'attempt': outbound.attempts,
+					'error': str(e)})
+			self.statusHandler(outbound)
+
+			with self.condition:
+				if delay is not None:
+					self._schedule(roomId, time.monotonic() + delay)
+					continue
+				self.rooms[roomId].popleft()
+				if self.rooms[roomId]:
+					self._schedule(roomId, time.monotonic())
+				else:
+					del self.rooms[roomId]
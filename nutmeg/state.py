@@ -0,0 +1,354 @@
+"""
+Room state kept locally, so rendering never has to fetch it from the homeserver.
+"""
+
+import matrix_client.room
+
+import logging
+state_logger = logging.getLogger('root')
+
+class RoomState:
+	"""
+	Locally kept state of a room.
+		Members are indexed by user ID, so display names resolve in O(1) without network I/O.
+		The index is filled once from the homeserver, then kept current from m.room.member events.
+		The room's name, topic and aliases are kept current from their state events, so the room header draws without network I/O.
+
+	Args:
+		roomId (str): ID of the room
+
+	Attributes:
+		roomId (str): ID of the room
+		displayNames (dict): Display name of each known member, keyed by user ID. None if they have none.
+		memberships (dict): Membership of each known member, keyed by user ID. E.g. 'join'
+		memberTs (dict): origin_server_ts of the event each member's entry came from, keyed by user ID.
+			CURRENT if it came from the room's current state, so historical events can't overwrite it.
+		membersLoaded (bool): Whether the member list has been loaded from the homeserver
+		membersVersion (int): Incremented whenever the member index changes, so renders showing members' names can tell they're stale
+		version (int): Incremented whenever any of the state changes, so a dump of unchanged state can be reused
+		stateTs (dict): origin_server_ts of the event each other piece of state came from, keyed by (type, state_key).
+			CURRENT if it came from the room's current state, as with memberTs.
+		name (str or None): Name of the room
+		topic (str or None): Topic of the room
+		aliases (list): Aliases of the room
+		canonicalAlias (str or None): Canonical alias of the room
+
+	Class Attributes:
+		CURRENT (float): memberTs value for entries from the room's current state
+	"""
+
+	CURRENT = float('inf')
+
+	def __init__(self, roomId:str):
+		self.roomId = roomId
+		self.displayNames = {}
+		self.memberships = {}
+		self.memberTs = {}
+		self.membersLoaded = False
+		self.membersVersion = 0
+		self.version = 0
+		self.stateTs = {}
+		self.name = None
+		self.topic = None
+		self.aliases = []
+		self.canonicalAlias = None
+
+	def setJoinedMembers(self, members:list):
+		"""
+		Fill the member index from a list of the room's joined members, as from Room.get_joined_members.
+			Lets the list be fetched off the UI thread, and the index filled on it.
+
+		Args:
+			members (list): The joined members, as matrix_client.user.User
+		"""
+
+		for member in members:
+			self.displayNames[member.user_id] = member.displayname
+			self.memberships[member.user_id] = 'join'
+			self.memberTs[member.user_id] = self.CURRENT
+		self.membersLoaded = True
+		self.membersVersion += 1
+		self.version += 1
+		state_logger.info('Loaded %(count)d members of room %(roomId)s' %
+			{'count': len(self.displayNames),
+			'roomId': self.roomId})
+
+	def updateMember(self, event:dict, current:bool = True):
+		"""
+		Update the member index from an m.room.member event.
+
+		Args:
+			event (dict): The m.room.member event
+			current (bool, optional): Defaults to True. Whether the event is new, rather than from history (e.g. a backfill).
+				Events from history only update members we don't have newer information about.
+		"""
+
+		userId = event['state_key']
+		ts = self.CURRENT if current else event.get('origin_server_ts', 0)
+		if not current and ts <= self.memberTs.get(userId, -1): return
+
+		self.displayNames[userId] = event['content'].get('displayname')
+		self.memberships[userId] = event['content']['membership']
+		self.memberTs[userId] = ts
+		self.membersVersion += 1
+		self.version += 1
+
+	def isNewer(self, event:dict, current:bool = True) -> bool:
+		"""
+		Check whether a state event is newer than the state we have from the same type and state_key, and if so record it.
+		
+		Args:
+			event (dict): The state event
+			current (bool, optional): Defaults to True. Whether the event is new, rather than from history (e.g. a backfill).
+				New events are always newer.
+		
+		Returns:
+			bool: Whether the event should update the state
+		"""
+
+		key = (event['type'], event.get('state_key', ''))
+		ts = self.CURRENT if current else event.get('origin_server_ts', 0)
+		if not current and ts <= self.stateTs.get(key, -1): return(False)
+		self.stateTs[key] = ts
+		return(True)
+
+	def updateName(self, event:dict, current:bool = True):
+		"""
+		Update the room's name from an m.room.name event.
+		
+		Args:
+			event (dict): The m.room.name event
+			current (bool, optional): Defaults to True. Whether the event is new, rather than from history (e.g. a backfill)
+		"""
+
+		if not self.isNewer(event, current): return
+		self.name = event['content'].get('name') or None
+		self.version += 1
+
+	def updateTopic(self, event:dict, current:bool = True):
+		"""
+		Update the room's topic from an m.room.topic event.
+		
+		Args:
+			event (dict): The m.room.topic event
+			current (bool, optional): Defaults to True. Whether the event is new, rather than from history (e.g. a backfill)
+		"""
+
+		if not self.isNewer(event, current): return
+		self.topic = event['content'].get('topic') or None
+		self.version += 1
+
+	def updateAliases(self, event:dict, current:bool = True):
+		"""
+		Update the room's aliases from an m.room.aliases event.
+			Each server has its own event (its state_key), listing the aliases on that server.
+		
+		Args:
+			event (dict): The m.room.aliases event
+			current (bool, optional): Defaults to True. Whether the event is new, rather than from history (e.g. a backfill)
+		"""
+
+		if not self.isNewer(event, current): return
+		server = event['state_key']
+		aliases = [alias for alias in self.aliases if alias.partition(':')[2] != server]
+		self.setAliases(aliases + [alias for alias in event['content']['aliases'] if alias not in aliases])
+
+	def updateCanonicalAlias(self, event:dict, current:bool = True):
+		"""
+		Update the room's canonical alias from an m.room.canonical_alias event.
+		
+		Args:
+			event (dict): The m.room.canonical_alias event
+			current (bool, optional): Defaults to True. Whether the event is new, rather than from history (e.g. a backfill)
+		"""
+
+		if not self.isNewer(event, current): return
+		self.setCanonicalAlias(event['content'].get('alias') or None)
+
+	def setAliases(self, aliases:list):
+		"""
+		Set the room's aliases, keeping RoomStates.aliasIndex up to date.
+		
+		Args:
+			aliases (list): The aliases
+		"""
+
+		previous = self.knownAliases()
+		self.aliases = list(aliases)
+		self.version += 1
+		RoomStates.reindexAliases(self.roomId, previous, self.knownAliases())
+
+	def setCanonicalAlias(self, alias:str):
+		"""
+		Set the room's canonical alias, keeping RoomStates.aliasIndex up to date.
+		
+		Args:
+			alias (str or None): The canonical alias
+		"""
+
+		previous = self.knownAliases()
+		self.canonicalAlias = alias
+		self.version += 1
+		RoomStates.reindexAliases(self.roomId, previous, self.knownAliases())
+
+	def knownAliases(self) -> set:
+		"""
+		Get every alias of the room we know of: its aliases and its canonical alias.
+		
+		Returns:
+			set: The aliases
+		"""
+
+		aliases = set(self.aliases)
+		if self.canonicalAlias is not None: aliases.add(self.canonicalAlias)
+		return(aliases)
+
+	def dump(self) -> dict:
+		"""
+		Get the state as a JSON-serializable dict, to be restored later with restore.
+			Only members' current state is kept, not where it came from.
+			The dict shares nothing with the state, so may be serialized on another thread.
+
+		Returns:
+			dict: The state
+		"""
+
+		return({
+			'name': self.name,
+			'topic': self.topic,
+			'aliases': list(self.aliases),
+			'canonical_alias': self.canonicalAlias,
+			'members': {userId: [self.displayNames.get(userId), membership]
+				for userId, membership in self.memberships.items()},
+			'members_loaded': self.membersLoaded
+		})
+
+	def restore(self, data:dict):
+		"""
+		Restore the state from a dict, as from dump.
+			Restored members are treated as current state.
+
+		Args:
+			data (dict): The state
+		"""
+
+		self.name = data.get('name')
+		self.topic = data.get('topic')
+		self.setAliases(data.get('aliases', []))
+		self.setCanonicalAlias(data.get('canonical_alias'))
+		for userId, (displayName, membership) in data.get('members', {}).items():
+			self.displayNames[userId] = displayName
+			self.memberships[userId] = membership
+			self.memberTs[userId] = self.CURRENT
+		self.membersVersion += 1
+		self.version += 1
+		self.membersLoaded = data.get('members_loaded', False)
+
+	def getDisplayName(self, userId:str) -> str:
+		"""
+		Get a member's display name.
+
+		Args:
+			userId (str): Matrix user ID
+
+		Returns:
+			str: The member's display name, or their user ID if they have none or aren't known
+		"""
+
+		displayName = self.displayNames.get(userId)
+		if not displayName: return(userId)
+		return(displayName)
+
+	def getRoomName(self, userId:str) -> str:
+		"""
+		Get the name to show for the room: its name, or failing that an alias, or failing that its other members.
+		
+		Args:
+			userId (str): Matrix user ID of the user viewing the room, who isn't listed as another member
+		
+		Returns:
+			str: The room's name
+		"""
+
+		if self.name: return(self.name)
+		if self.canonicalAlias: return(self.canonicalAlias)
+		if self.aliases: return(self.aliases[0])
+		others = sorted(self.getDisplayName(memberId) for memberId, membership in self.memberships.items()
+			if membership == 'join' and memberId != userId)
+		if len(others) == 1: return(others[0])
+		if len(others) == 2: return('%(first)s and %(second)s' % {'first': others[0], 'second': others[1]})
+		if others: return('%(first)s and %(count)d others' % {'first': others[0], 'count': len(others) - 1})
+		return(self.roomId)
+
+class RoomStates:
+	"""
+	Container for the RoomState of each room, and an index of their aliases.
+		Only RoomStates.get and RoomStates.resolveAlias should usually be used.
+
+	Class Attributes:
+		states (dict): RoomState of each room, keyed by room ID
+		aliasIndex (dict): Room ID of each known alias, keyed by alias.
+			Kept up to date from each RoomState's aliases, so resolving an alias needs no network I/O.
+	"""
+
+	states = {}
+	aliasIndex = {}
+
+	@staticmethod
+	def get(room:matrix_client.room.Room) -> RoomState:
+		"""
+		Get the RoomState of a room, creating it if needed.
+
+		Args:
+			room (matrix_client.room.Room): The room
+
+		Returns:
+			RoomState: The room's state
+		"""
+
+		if room.room_id not in RoomStates.states:
+			RoomStates.states[room.room_id] = RoomState(room.room_id)
+		return(RoomStates.states[room.room_id])
+
+	@staticmethod
+	def resolveAlias(alias:str) -> str:
+		"""
+		Look up the room an alias belongs to, among the rooms we know of.
+		
+		Args:
+			alias (str): Room alias, e.g. '#room:example.org'
+		
+		Returns:
+			str or None: ID of the room, or None if the alias isn't known
+		"""
+
+		return(RoomStates.aliasIndex.get(alias))
+
+	@staticmethod
+	def addAlias(alias:str, roomId:str):
+		"""
+		Record the room an alias belongs to, e.g. once it's been resolved by joining it.
+		
+		Args:
+			alias (str): Room alias
+			roomId (str): ID of the room
+		"""
+
+		RoomStates.aliasIndex[alias] = roomId
+
+	@staticmethod
+	def reindexAliases(roomId:str, previous:set, current:set):
+		"""
+		Update the alias index for a room's aliases changing.
+			Aliases the room no longer has are only removed if they still point to it.
+		
+		Args:
+			roomId (str): ID of the room
+			previous (set): The room's previous aliases
+			current (set): The room's current aliases
+		"""
+
+		for alias in previous - current:
+			if RoomStates.aliasIndex.get(alias) == roomId: del RoomStates.aliasIndex[alias]
+		for alias in current:
+			RoomStates.aliasIndex[alias] = roomId
@@ -0,0 +1,230 @@
+"""
+Local on-disk storage of room events and sync state, so they survive restarts.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+
+try:
+	from .utils import redactedEvent
+except ImportError:
+	from utils import redactedEvent
+
+import logging
+store_logger = logging.getLogger('root')
+
+class EventStore:
+	"""
+	SQLite store of raw events, per room.
+		Events are indexed by event_id, and by (room_id, origin_server_ts) so a room's latest history loads without a scan.
+		Redactions are applied to the stored events, so redacted content isn't kept on disk.
+		The store may be used from several threads (e.g. the sync listener and the UI).
+
+	Args:
+		path (str): Path of the database file. Its directory is created if needed. ':memory:' keeps the store in memory.
+
+	Attributes:
+		path (str): Path of the database file
+	"""
+
+	def __init__(self, path:str):
+		self.path = path
+		if path != ':memory:':
+			directory = os.path.dirname(path)
+			if directory: os.makedirs(directory, exist_ok=True)
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(path, check_same_thread=False)
+		with self.lock, self.connection:
+			self.connection.execute('PRAGMA journal_mode=WAL')
+			self.connection.execute('PRAGMA synchronous=NORMAL')
+			self.connection.execute('''CREATE TABLE IF NOT EXISTS events (
+				event_id TEXT PRIMARY KEY,
+				room_id TEXT NOT NULL,
+				origin_server_ts INTEGER NOT NULL,
+				event TEXT NOT NULL)''')
+			self.connection.execute('CREATE INDEX IF NOT EXISTS events_room_ts ON events (room_id, origin_server_ts)')
+			created = not self.connection.execute(
+				"SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'redactions'").fetchone()
+			# Redactions by the event_id they redact, including those of events which aren't stored yet
+			self.connection.execute('''CREATE TABLE IF NOT EXISTS redactions (
+				redacts TEXT PRIMARY KEY,
+				event TEXT NOT NULL)''')
+			if created:
+				# Apply redactions stored before redactions were tracked
+				redactions = [json.loads(row[0]) for row in self.connection.execute(
+					"SELECT event FROM events WHERE event LIKE '%m.room.redaction%'")]
+				self._addRedactions(redactions)
+				self._applyRedactions([redaction['redacts'] for redaction in redactions if self.isRedaction(redaction)])
+
+	def addEvents(self, roomId:str, events:list):
+		"""
+		Store events from a room, in one transaction.
+			Events without an event_id or origin_server_ts (e.g. Nutmeg's own output) aren't stored.
+			Events which are already stored are left as they are, unless they're redacted.
+			Redactions are applied to the events they redact, whether those are stored already or later.
+
+		Args:
+			roomId (str): ID of the room the events are from
+			events (list): Events to store
+		"""
+
+		rows = [(event['event_id'], roomId, int(event['origin_server_ts']), json.dumps(event))
+			for event in events
+			if 'event_id' in event and 'origin_server_ts' in event]
+		if not rows: return
+		redactions = [event for event in events if self.isRedaction(event)]
+		with self.lock, self.connection:
+			self.connection.executemany('INSERT OR IGNORE INTO events VALUES (?, ?, ?, ?)', rows)
+			self._addRedactions(redactions)
+			self._applyRedactions([row[0] for row in rows] + [redaction['redacts'] for redaction in redactions])
+
+	@staticmethod
+	def isRedaction(event:dict) -> bool:
+		"""
+		Check whether an event is a redaction which can be applied.
+
+		Args:
+			event (dict): Event to check
+
+		Returns:
+			bool: True if the event redacts another
+		"""
+
+		return(event.get('type') == 'm.room.redaction' and isinstance(event.get('redacts'), str) and 'event_id' in event)
+
+	def _addRedactions(self, redactions:list):
+		# Must be called with the lock held, in a transaction
+		self.connection.executemany('INSERT OR IGNORE INTO redactions VALUES (?, ?)',
+			[(redaction['redacts'], json.dumps(redaction)) for redaction in redactions if self.isRedaction(redaction)])
+
+	def _applyRedactions(self, eventIds:list):
+		"""
+		Replace stored events which have a stored redaction with their redacted form.
+			Must be called with the lock held, in a transaction.
+
+		Args:
+			eventIds (list): Event IDs to check
+		"""
+
+		eventIds = list(set(eventIds))
+		# SQLite limits the number of parameters per statement
+		for start in range(0, len(eventIds), 500):
+			batch = eventIds[start:start+500]
+			rows = self.connection.execute('''SELECT events.event, redactions.event FROM events
+				JOIN redactions ON redactions.redacts = events.event_id
+				WHERE events.event_id IN (%(params)s)''' %
+				{'params': ', '.join('?' * len(batch))}, batch).fetchall()
+			updates = []
+			for eventJson, redactionJson in rows:
+				event = json.loads(eventJson)
+				if 'redacted_because' in event.get('unsigned', {}): continue
+				try:
+					redacted = redactedEvent(event, json.loads(redactionJson))
+				except KeyError as e:
+					store_logger.error('Could not redact stored event %(eventId)s: missing %(key)s' %
+						{'eventId': event.get('event_id'),
+						'key': str(e)})
+					continue
+				updates.append((json.dumps(redacted), event['event_id']))
+			self.connection.executemany('UPDATE events SET event = ? WHERE event_id = ?', updates)
+
+	def getEvents(self, roomId:str, limit:int, before:int = None) -> list:
+		"""
+		Get a room's latest stored events.
+
+		Args:
+			roomId (str): ID of the room
+			limit (int): Maximum number of events to get
+			before (int, optional): Defaults to None. If set, only get events with an origin_server_ts before this
+
+		Returns:
+			list: Events, ordered old to new
+		"""
+
+		if before is None: before = float('inf')
+		with self.lock:
+			rows = self.connection.execute('''SELECT event FROM events
+				WHERE room_id = ? AND origin_server_ts < ?
+				ORDER BY origin_server_ts DESC, event_id DESC
+				LIMIT ?''', (roomId, before, limit)).fetchall()
+		return([json.loads(row[0]) for row in reversed(rows)])
+
+	def knownEventIds(self, eventIds:list) -> set:
+		"""
+		Find which of a list of events are stored.
+
+		Args:
+			eventIds (list): Event IDs to look for
+
+		Returns:
+			set: The event IDs which are stored
+		"""
+
+		eventIds = list(eventIds)
+		known = set()
+		with self.lock:
+			# SQLite limits the number of parameters per statement
+			for start in range(0, len(eventIds), 500):
+				batch = eventIds[start:start+500]
+				rows = self.connection.execute('SELECT event_id FROM events WHERE event_id IN (%(params)s)' %
+					{'params': ', '.join('?' * len(batch))}, batch).fetchall()
+				known.update(row[0] for row in rows)
+		return(known)
+
+	def close(self):
+		with self.lock:
+			self.connection.close()
+
+class SessionStore:
+	"""
+	JSON file holding what's needed to resume syncing where the last run left off:
+		the last sync token, and the state of each room.
+		The file is replaced atomically, so a crash while saving leaves the previous session intact.
+
+	Args:
+		path (str): Path of the session file. Its directory is created if needed.
+
+	Attributes:
+		path (str): Path of the session file
+	"""
+
+	def __init__(self, path:str):
+		self.path = path
+		self.lock = threading.Lock()
+
+	def load(self) -> dict:
+		"""
+		Load the saved session.
+
+		Returns:
+			dict or None: The session, or None if there isn't a readable one
+		"""
+
+		try:
+			with open(self.path, 'r') as sessionFile:
+				return(json.load(sessionFile))
+		except FileNotFoundError:
+			return(None)
+		except (OSError, ValueError) as e:
+			store_logger.error('Could not load session from %(path)s: %(error)s' %
+				{'path': self.path,
+				'error': str(e)})
+			return(None)
+
+	def save(self, session:dict):
+		"""
+		Save a session, replacing the saved one.
+
+		Args:
+			session (dict): JSON-serializable session
+		"""
+
+		directory = os.path.dirname(self.path)
+		if directory: os.makedirs(directory, exist_ok=True)
+		with self.lock:
+			tempPath = self.path + '.tmp'
+			with open(tempPath, 'w') as sessionFile:
+				json.dump(session, sessionFile)
+			os.replace(tempPath, self.path)
@@ -0,0 +1,219 @@
+"""
+Sorted storage for a room's timeline.
+"""
+
+import bisect
+
+class Timeline:
+	"""
+	List of items kept sorted by key, oldest first.
+		Items are stored in blocks of up to 2 * blockSize, so inserting only shifts the items of one block.
+		Adding an item newer than every other (e.g. a live event) appends to the last block, in amortized O(1).
+		Adding an older item (e.g. from a backfill) is O(log n + blockSize).
+		Positions count from 0, the oldest item.
+
+	Class Attributes:
+		blockSize (int): Target number of items per block
+
+	Attributes:
+		blocks (list): Lists of items, oldest first
+		keys (list): Lists of the keys of the items in each block
+		maxes (list): Key of the newest item in each block
+	"""
+
+	blockSize = 256
+
+	def __init__(self):
+		self.blocks = []
+		self.keys = []
+		self.maxes = []
+		self.offsets = []
+		# Position of the first item of each block
+		# None when out of date; rebuilt when next needed
+		self.length = 0
+
+	def __len__(self) -> int:
+		return(self.length)
+
+	def __iter__(self):
+		for block in self.blocks:
+			yield from block
+
+	def __reversed__(self):
+		for block in reversed(self.blocks):
+			yield from reversed(block)
+
+	def __getitem__(self, position:int):
+		if position < 0: position += self.length
+		if not 0 <= position < self.length: raise IndexError('Timeline index out of range')
+		b = bisect.bisect_right(self._offsets(), position) - 1
+		return(self.blocks[b][position - self.offsets[b]])
+
+	def add(self, key, item) -> int:
+		"""
+		Add an item at its place in the timeline.
+
+		Args:
+			key: Sort key of the item, e.g. (origin_server_ts, event_id)
+			item: Item to add
+
+		Returns:
+			int: Position the item was added at
+		"""
+
+		b, i = self._insert(key, item)
+		return(self._offsets()[b] + i)
+
+	def merge(self, run:list) -> int:
+		"""
+		Add a run of items at their places in the timeline.
+			A run of k items costs O(k (log n + blockSize)), rather than sorting the whole timeline again.
+
+		Args:
+			run (list): (key, item) tuples to add, in any order
+
+		Returns:
+			int: Lowest position an item may have been added at, or len(self) if the run was empty.
+				Items after this position have moved.
+		"""
+
+		run = sorted(run, key=lambda pair: pair[0])
+		if not run: return(self.length)
+		for key, item in run:
+			self._insert(key, item)
+		return(self.position(run[0][0]))
+
+	def position(self, key) -> int:
+		"""
+		Find where a key is in the timeline, in O(log n).
+
+		Args:
+			key: Key to find
+
+		Returns:
+			int: Position of the first item with a key of at least key. len(self) if there is none.
+		"""
+
+		b = bisect.bisect_left(self.maxes, key)
+		if b == len(self.blocks): return(self.length)
+		return(self._offsets()[b] + bisect.bisect_left(self.keys[b], key))
+
+	def remove(self, key) -> int:
+		"""
+		Remove the first item with a key.
+
+		Args:
+			key: Key of the item to remove
+
+		Raises:
+			KeyError: If no item has the key
+
+		Returns:
+			int: Position the item was at
+		"""
+
+		b = bisect.bisect_left(self.maxes, key)
+		if b == len(self.blocks): raise KeyError(key)
+		i = bisect.bisect_left(self.keys[b], key)
+		if self.keys[b][i] != key: raise KeyError(key)
+		position = self._offsets()[b] + i
+
+		del self.blocks[b][i]
+		del self.keys[b][i]
+		if self.blocks[b]:
+			self.maxes[b] = self.keys[b][-1]
+		else:
+			del self.blocks[b]
+			del self.keys[b]
+			del self.maxes[b]
+		self.offsets = None
+		self.length -= 1
+		return(position)
+
+	def slice(self, start:int, stop:int) -> list:
+		"""
+		Get the items between two positions.
+
+		Args:
+			start (int): First position to get
+			stop (int): Position to stop at (exclusive)
+
+		Returns:
+			list: Items, oldest first
+		"""
+
+		start = max(start, 0)
+		stop = min(stop, self.length)
+		if start >= stop: return([])
+		offsets = self._offsets()
+		b = bisect.bisect_right(offsets, start) - 1
+		items = []
+		i = start - offsets[b]
+		while len(items) < stop - start:
+			items.extend(self.blocks[b][i:i + stop - start - len(items)])
+			b += 1
+			i = 0
+		return(items)
+
+	def _insert(self, key, item) -> tuple:
+		"""
+		Insert an item, without working out its position.
+
+		Returns:
+			tuple: (block, index in block) the item was inserted at
+		"""
+
+		self.length += 1
+		if not self.blocks:
+			self.blocks.append([item])
+			self.keys.append([key])
+			self.maxes.append(key)
+			self.offsets = [0]
+			return((0, 0))
+
+		if key >= self.maxes[-1]:
+			# Newest item; the positions of earlier items don't change
+			b = len(self.blocks) - 1
+			i = len(self.blocks[b])
+			self.blocks[b].append(item)
+			self.keys[b].append(key)
+			self.maxes[b] = key
+		else:
+			b = bisect.bisect_right(self.maxes, key)
+			i = bisect.bisect_right(self.keys[b], key)
+			self.blocks[b].insert(i, item)
+			self.keys[b].insert(i, key)
+			self.offsets = None
+
+		if len(self.blocks[b]) > 2 * self.blockSize:
+			half = self._split(b)
+			if i >= half: b, i = b + 1, i - half
+		return((b, i))
+
+	def _split(self, b:int) -> int:
+		"""
+		Split a block in half.
+
+		Returns:
+			int: Number of items left in the first half
+		"""
+
+		half = len(self.blocks[b]) // 2
+		self.blocks.insert(b + 1, self.blocks[b][half:])
+		self.keys.insert(b + 1, self.keys[b][half:])
+		del self.blocks[b][half:]
+		del self.keys[b][half:]
+		self.maxes[b] = self.keys[b][-1]
+		self.maxes.insert(b + 1, self.keys[b + 1][-1])
+		if self.offsets is not None:
+			self.offsets.insert(b + 1, self.offsets[b] + half)
+		return(half)
+
+	def _offsets(self) -> list:
+		if self.offsets is None:
+			self.offsets = []
+			position = 0
+			for block in self.blocks:
+				self.offsets.append(position)
+				position += len(block)
+		return(self.offsets)
@@ -1,6 +1,5 @@
 import datetime
 import matrix_client.room
-import matrix_client.user
 
 #
 # Utility Functions
@@ -84,6 +83,58 @@ def checkStructure(item:dict, structure:dict) -> bool:
 	# If every key is correct, we're good
 	return(True)
 
+def compileStructure(structure:dict) -> callable:
+	"""
+	Compile a structure definition into a predicate function.
+		The predicate gives the same result as utils.checkStructure with the same structure,
+		but the structure is only read once, here, rather than on every call.
+		The checks are generated as straight-line code, so there is no per-key branching or recursion.
+	
+	Args:
+		structure (dict): Structure required, in the format used by utils.checkStructure
+	
+	Returns:
+		callable: Function taking an item (dict) and returning whether its structure matches
+	"""
+
+	namespace = {}
+	lines = ['def check(item0):']
+	_compileStructureLines(structure, 0, lines, namespace)
+	lines.append('\treturn(True)')
+	exec('\n'.join(lines), namespace)
+	return(namespace['check'])
+
+def _compileStructureLines(structure:dict, depth:int, lines:list, namespace:dict):
+	"""
+	Generate the source lines checking one level of a structure, for compileStructure.
+		Keys, types and required values are passed in through the namespace rather than as literals.
+	
+	Args:
+		structure (dict): Structure (or substructure) required
+		depth (int): Nesting depth of the substructure. The item being checked is in the variable item<depth>
+		lines (list): Source lines to append to
+		namespace (dict): Namespace the function is compiled in, to add constants to
+	"""
+
+	item = 'item%(depth)d' % {'depth': depth}
+	for key, required in structure.items():
+		keyName = 'c%(n)d' % {'n': len(namespace)}
+		namespace[keyName] = key
+		lines.append('\tif %(key)s not in %(item)s: return(False)' % {'key': keyName, 'item': item})
+		if isinstance(required, dict):
+			subitem = 'item%(depth)d' % {'depth': depth+1}
+			lines.append('\t%(subitem)s = %(item)s[%(key)s]' % {'subitem': subitem, 'item': item, 'key': keyName})
+			_compileStructureLines(required, depth+1, lines, namespace)
+			continue
+		requiredName = 'c%(n)d' % {'n': len(namespace)}
+		namespace[requiredName] = required
+		if isinstance(required, type):
+			lines.append('\tif not isinstance(%(item)s[%(key)s], %(required)s): return(False)' %
+				{'item': item, 'key': keyName, 'required': requiredName})
+		else:
+			lines.append('\tif %(item)s[%(key)s] != %(required)s: return(False)' %
+				{'item': item, 'key': keyName, 'required': requiredName})
+
 def tsToDt(timestamp: str) -> str:
 	"""
 	Convert a timestamp string to a human-readable string.
@@ -106,59 +157,12 @@ def nowToTs() -> str:
 	Returns the current time as a Matrix-compatible timestamp.
 	
 	Returns:
-		str: Timestamp
+		str: Timestamp, in whole milliseconds
 	"""
 	dtTs = datetime.datetime.timestamp(datetime.datetime.now())
-	ts = str(dtTs*1000)
+	ts = str(int(dtTs*1000))
 	return(ts)
 
-def getEvent(room: matrix_client.room.Room, eventId: str) -> dict:
-	"""
-	Gets an event from a room by event ID.
-	
-	Arguments:
-		room (matrix_client.room.Room): Room in which to look for the event
-		eventId (str): Matrix event ID
-	
-	Raises:
-		KeyError: If the event is not found in the room's events.
-			Usually this is because it's not been backfilled in yet.
-	
-	Returns:
-		dict: The event dict
-	"""
-
-	for event in room.events:
-		if event['event_id'] == eventId:
-			return(event)
-	else:
-		raise KeyError('Event %(eventId)s not found. Do you need to call room.backfill_previous_messages?' %
-			{'eventId': str(eventId)})
-
-def getMember(room: matrix_client.room.Room, userId: str) -> matrix_client.user.User:
-	"""
-	Gets a member of a room by user ID.
-	
-	Arguments:
-		room (matrix_client.room.Room): Room from which to retrieve the member
-		userId (str): Matrix user ID
-	
-	Raises:
-		KeyError: If the user is not found
-
-	Returns:
-		matrix_client.user.User
-	"""
-
-	for member in room.get_joined_members():
-		if member.user_id == userId:
-			return(member)
-	else:
-		raise KeyError('User %(userId)s not found in room %(roomName)s (%(roomId)s).' %
-			{'userId': str(userId),
-			'roomName': str(room.display_name),
-			'roomId': str(room.room_id)})
-
 def getLastChar(window) -> tuple:
 	"""
 	Returns the last filled character in a window object.
@@ -179,27 +183,6 @@ def getLastChar(window) -> tuple:
 			if window.instr(y,x,1) != b' ':
 				return(y,x)
 	raise IndexError('No filled characters in window.')
-def getLastChar2(window) -> tuple:
-	"""
-	Returns the last filled character in a window object.
-	
-	Arguments:
-		window (curses.window): The window to check
-
-	Raises:
-		IndexError
-	
-	Returns:
-		tuple (y,x): The (y,x) of the last filled character, relative to the window
-	"""
-	lastYX = None
-	height, width = window.getmaxyx()
-	for y in range(height):
-		for x in range(width):
-			if window.instr(y,x,1) != b' ':
-				lastYX = (y,x)
-	if lastYX is None: raise IndexError('No filled characters in window.')
-	return(lastYX)
 
 def stripAutoNewlines(text: str, interval: int) -> str:
 	"""
@@ -224,6 +207,50 @@ def stripAutoNewlines(text: str, interval: int) -> str:
 	if newText[-1] == '\n': newText = newText[:-1]
 	return(newText)
 
+def redactedEvent(event:dict, redaction:dict) -> dict:
+	"""
+	Make the event replacing a redacted event.
+		Like a redaction by the homeserver, the content is stripped but the type is kept.
+	
+	Args:
+		event (dict): Event being redacted
+		redaction (dict): Event of the redaction
+	
+	Returns:
+		dict: Event to build a RedactedEvent from
+	"""
+
+	return({
+		'type': event['type'],
+		'content': {},
+		'event_id': event['event_id'],
+		'sender': event['sender'],
+		'origin_server_ts': event['origin_server_ts'],
+		'unsigned': {
+			'redacted_because': {
+				'event_id': redaction['event_id']
+			}
+		}
+	})
+
+def getMessagesBefore(room: matrix_client.room.Room, token: str, limit: int = 10) -> tuple:
+	"""
+	Fetch a page of messages from before a pagination token, without dispatching them to the room's listeners.
+	
+	Args:
+		room (matrix_client.room.Room): Room to fetch messages for
+		token (str): Pagination token to go back from, e.g. room.prev_batch
+		limit (int): Number of messages to go back.
+	
+	Returns:
+		tuple: (events, token). Events in the chunk, ordered old to new,
+			and the token to fetch the page before them (None if there are no more)
+	"""
+
+	res = room.client.api.get_room_messages(room.room_id, token, direction="b", limit=limit)
+	if not res['chunk']: return(([], None))
+	return((list(reversed(res['chunk'])), res.get('end')))
+
 def backfill_previous_messages_and_update_batch(room, reverse=False, limit=10):
 	"""Backfill handling of previous messages, then update prev_batch
 	Allows for loading of older messages.
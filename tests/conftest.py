@@ -0,0 +1,23 @@
+"""
+Shared setup for the tests: makes the nutmeg package importable, without needing matrix_client installed.
+"""
+
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+	import matrix_client.room
+	import matrix_client.user
+except ImportError:
+	# Only the names are needed to import nutmeg's modules, so stand in for matrix_client if it isn't installed
+	matrix_client = types.ModuleType('matrix_client')
+	for name in ('room', 'user', 'client'):
+		module = types.ModuleType('matrix_client.' + name)
+		setattr(matrix_client, name, module)
+		sys.modules['matrix_client.' + name] = module
+	matrix_client.room.Room = type('Room', (), {})
+	matrix_client.user.User = type('User', (), {})
+	sys.modules['matrix_client'] = matrix_client
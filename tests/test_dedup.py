@@ -0,0 +1,48 @@
+"""
+Checks BloomFilter and SeenSet membership.
+"""
+
+from nutmeg.dedup import BloomFilter, SeenSet
+
+def test_bloomFilterHasNoFalseNegatives():
+	bloomFilter = BloomFilter(1000, 0.01)
+	items = ['$%d' % i for i in range(1000)]
+	for item in items:
+		bloomFilter.add(item)
+	assert all(item in bloomFilter for item in items)
+	assert bloomFilter.full()
+
+def test_bloomFilterFalsePositiveRate():
+	bloomFilter = BloomFilter(1000, 0.01)
+	for i in range(1000):
+		bloomFilter.add('$%d' % i)
+	falsePositives = sum('$other%d' % i in bloomFilter for i in range(10000))
+	# Allow a wide margin, as the rate is only expected
+	assert falsePositives < 10000 * 0.01 * 3
+
+def test_seenSetRemembersWindow():
+	recentLimit, filterCapacity, filterCount = 10, 20, 2
+	for count in range(1, 200):
+		seenSet = SeenSet(recentLimit=recentLimit, filterCapacity=filterCapacity, filterCount=filterCount)
+		items = ['$%d' % i for i in range(count)]
+		for item in items:
+			seenSet.add(item)
+		window = items[-(recentLimit + filterCount * filterCapacity):]
+		assert all(item in seenSet for item in window), count
+		assert len(seenSet.recent) == min(count, recentLimit)
+		assert len(seenSet.filters) <= filterCount + 1
+
+def test_seenSetForgetsOldest():
+	seenSet = SeenSet(recentLimit=10, filterCapacity=20, filterCount=2, falsePositiveRate=1e-9)
+	items = ['$%d' % i for i in range(200)]
+	for item in items:
+		seenSet.add(item)
+	# At most recentLimit + (filterCount + 1) * filterCapacity are kept
+	assert not any(item in seenSet for item in items[:200 - 70])
+
+def test_seenSetReaddIsRecent():
+	seenSet = SeenSet(recentLimit=3, filterCapacity=100, filterCount=1)
+	for item in ['$a', '$b', '$c', '$a', '$d']:
+		seenSet.add(item)
+	assert list(seenSet.recent) == ['$c', '$a', '$d']
+	assert '$b' in seenSet
@@ -0,0 +1,73 @@
+"""
+Checks message layout and the HeightIndex against simple reference computations, without a terminal.
+"""
+
+import random
+
+from nutmeg.layout import layoutSegments, layoutHeight, textWidth, HeightIndex
+
+def lineTexts(lines:list) -> list:
+	return([''.join(text for text, attr in line) for line in lines])
+
+def test_wrapsWhenLineFills():
+	lines = layoutSegments([('abcdefgh', 0)], 3)
+	assert lineTexts(lines) == ['abc', 'def', 'gh']
+	assert layoutHeight(lines) == 3
+
+def test_filledLineThenNewlineLeavesBlankLine():
+	# Like curses, filling a line moves the cursor to the next, so the newline ends that one
+	lines = layoutSegments([('abc\nd', 0)], 3)
+	assert lineTexts(lines) == ['abc', '', 'd']
+	assert layoutHeight(lines) == 3
+
+def test_newlines():
+	lines = layoutSegments([('a\n\nb\n', 0)], 10)
+	assert lineTexts(lines) == ['a', '', 'b', '']
+	assert layoutHeight(lines) == 3
+
+def test_trailingBlankLinesNotCounted():
+	assert layoutHeight(layoutSegments([('a\n   \n\n', 0)], 10)) == 1
+	assert layoutHeight(layoutSegments([('', 0)], 10)) == 0
+
+def test_tabsAdvanceToTabStop():
+	lines = layoutSegments([('ab\tc', 0)], 20)
+	assert lineTexts(lines) == ['ab      c']
+	# A tab past the end of the line wraps like the spaces it's drawn as
+	lines = layoutSegments([('abcdef\tg', 0)], 7)
+	assert lineTexts(lines) == ['abcdef ', ' g']
+
+def test_wideCharactersWrapWhole():
+	lines = layoutSegments([('ab中文', 0)], 3)
+	assert lineTexts(lines) == ['ab', '中', '文']
+	assert all(textWidth(text) <= 3 for text in lineTexts(lines))
+
+def test_controlCharactersShownAsCaret():
+	assert lineTexts(layoutSegments([('a\x01b', 0)], 10)) == ['a^Ab']
+
+def test_segmentsKeepTheirAttrs():
+	lines = layoutSegments([('ab', 1), ('cd', 2)], 3)
+	assert lines == [[('ab', 1), ('c', 2)], [('d', 2)]]
+
+def test_heightIndexMatchesSums():
+	generator = random.Random(1)
+	heights = [generator.randint(0, 5) for _ in range(50)]
+	index = HeightIndex(heights[:20])
+	for height in heights[20:]:
+		index.append(height)
+	for _ in range(100):
+		position = generator.randrange(len(heights))
+		heights[position] = generator.randint(0, 5)
+		index.update(position, heights[position])
+	assert len(index) == len(heights)
+	assert index.total() == sum(heights)
+	for position in range(len(heights) + 1):
+		assert index.prefix(position) == sum(heights[:position])
+
+def test_heightIndexFind():
+	heights = [2, 0, 3, 1, 0, 4]
+	index = HeightIndex(heights)
+	for row in range(sum(heights)):
+		position = index.find(row)
+		# The message covering the row starts at or before it, and ends after it
+		assert sum(heights[:position]) <= row < sum(heights[:position + 1])
+	assert index.find(sum(heights)) == len(heights)
@@ -0,0 +1,88 @@
+"""
+Checks MessageBuilder.selectMessageType's dispatch index against a full walk of the messageTypeTree.
+"""
+
+import random
+
+from nutmeg.message import MessageBuilder
+
+CORPUS_SIZE = 20000
+SEED = 1
+
+def buildCorpus(size:int, seed:int) -> list:
+	"""
+	Generate events mixing the values Message classes dispatch on with missing, unknown and malformed ones.
+
+	Args:
+		size (int): Number of events to generate
+		seed (int): Seed for the generator, so failures are reproducible
+
+	Returns:
+		list: Events
+	"""
+
+	generator = random.Random(seed)
+	choices = {}
+	for path in MessageBuilder.dispatchFields:
+		values = MessageBuilder._requiredValues(MessageBuilder.messageTypeTree, path)
+		choices[path] = values + [None, 'unknown', ['unhashable']]
+	extras = [
+		(('event_id',), '$event'),
+		(('sender',), '@user:example.org'),
+		(('origin_server_ts',), 1500000000000),
+		(('redacts',), '$other'),
+		(('content', 'body'), 'hello'),
+		(('content', 'body'), 5),
+		(('content', 'displayname'), 'User'),
+		(('content', 'aliases'), ['#room:example.org']),
+		(('content', 'alias'), '#room:example.org'),
+		(('content', 'name'), 'Room'),
+		(('content', 'topic'), 'Topic'),
+		(('content', 'creator'), '@user:example.org'),
+		(('content', 'join_rule'), 'public'),
+		(('content', 'join_rule'), 'unknown'),
+		(('content', 'membership'), 'knock'),
+		(('content', 'command'), 'help'),
+		(('content', 'message'), 'output'),
+		(('prev_content', 'displayname'), 'Old'),
+	]
+
+	corpus = []
+	for _ in range(size):
+		event = {}
+		for path, values in choices.items():
+			if generator.random() < 0.3: continue # Leave the field out
+			setPath(event, path, generator.choice(values))
+		# Most classes need several of these at once, so each is usually included. Later ones win where paths repeat.
+		for path, value in generator.sample(extras, len(extras)):
+			if generator.random() < 0.8: setPath(event, path, value)
+		# State and redacted events take priority over most classes, so are kept rarer
+		if generator.random() < 0.5:
+			setPath(event, ('state_key',), generator.choice(['', '@user:example.org', '@other:example.org']))
+		if generator.random() < 0.1:
+			setPath(event, ('unsigned', 'redacted_because'), {'event_id': '$redaction'})
+		corpus.append(event)
+	return(corpus)
+
+def setPath(item:dict, path:tuple, value):
+	# Set a value at a path of keys, replacing anything in the way which isn't a dict
+	for key in path[:-1]:
+		if not isinstance(item.get(key), dict): item[key] = {}
+		item = item[key]
+	item[path[-1]] = value
+
+def test_dispatchMatchesTreeWalk():
+	for event in buildCorpus(CORPUS_SIZE, SEED):
+		expected = MessageBuilder._selectInTypeTree(MessageBuilder.messageTypeTree, event)
+		assert MessageBuilder.selectMessageType(event) is expected, event
+
+def test_corpusCoversMessageTypes():
+	# The comparison is only meaningful if the corpus reaches most of the classes
+	selected = {MessageBuilder.selectMessageType(event) for event in buildCorpus(CORPUS_SIZE, SEED)}
+	classes = [cls for cls in MessageBuilder.messageTypeTree] + list(_descendants(MessageBuilder.messageTypeTree))
+	assert len(selected) >= len(classes) * 9 // 10, sorted(cls.__name__ for cls in set(classes) - selected)
+
+def _descendants(typeTree:dict):
+	for subtree in typeTree.values():
+		yield from subtree
+		yield from _descendants(subtree)
@@ -0,0 +1,27 @@
+"""
+Checks MessageQueues ordering, including Nutmeg's own output.
+"""
+
+from nutmeg.display import MessageQueues
+from nutmeg.event_builder import EventBuilder
+
+class Room:
+	def __init__(self, roomId:str):
+		self.room_id = roomId
+
+def message(eventId:str, ts:int) -> dict:
+	return({
+		'type': 'm.room.message',
+		'event_id': eventId,
+		'sender': '@user:example.org',
+		'origin_server_ts': ts,
+		'content': {'msgtype': 'm.text', 'body': eventId}
+	})
+
+def test_enqueueCommandOutput():
+	queues = MessageQueues()
+	room = Room('!room:example.org')
+	queues.enqueue(message('$old', 1000), room)
+	output = EventBuilder.commandOutput('help', 'Help text')
+	queues.enqueue(output, room)
+	assert [queued.event for queued in queues.getQueue(room)] == [output, message('$old', 1000)]
@@ -0,0 +1,78 @@
+"""
+Checks EventStore storage, and that redactions are applied to stored events.
+"""
+
+import json
+import sqlite3
+
+from nutmeg.store import EventStore
+
+ROOM = '!room:example.org'
+
+def message(eventId:str, ts:int) -> dict:
+	return({
+		'type': 'm.room.message',
+		'event_id': eventId,
+		'sender': '@user:example.org',
+		'origin_server_ts': ts,
+		'content': {'msgtype': 'm.text', 'body': 'secret ' + eventId}
+	})
+
+def redaction(eventId:str, redacts:str, ts:int) -> dict:
+	return({
+		'type': 'm.room.redaction',
+		'event_id': eventId,
+		'sender': '@user:example.org',
+		'origin_server_ts': ts,
+		'redacts': redacts,
+		'content': {}
+	})
+
+def storedEvents(store:EventStore) -> dict:
+	return({event['event_id']: event for event in store.getEvents(ROOM, 100)})
+
+def assertRedacted(event:dict, redactionId:str):
+	assert event['content'] == {}
+	assert event['unsigned']['redacted_because']['event_id'] == redactionId
+
+def test_getEventsOrderAndLimit():
+	store = EventStore(':memory:')
+	store.addEvents(ROOM, [message('$3', 3), message('$1', 1), message('$2', 2), {'type': 'n.output.command'}])
+	assert [event['event_id'] for event in store.getEvents(ROOM, 2)] == ['$2', '$3']
+	assert [event['event_id'] for event in store.getEvents(ROOM, 10, before=3)] == ['$1', '$2']
+	assert store.knownEventIds(['$1', '$4']) == {'$1'}
+
+def test_redactionAfterEvent():
+	store = EventStore(':memory:')
+	store.addEvents(ROOM, [message('$1', 1), message('$2', 2)])
+	store.addEvents(ROOM, [redaction('$r', '$1', 3)])
+	events = storedEvents(store)
+	assertRedacted(events['$1'], '$r')
+	assert events['$2']['content']['body'] == 'secret $2'
+
+def test_redactionBeforeEvent():
+	store = EventStore(':memory:')
+	store.addEvents(ROOM, [redaction('$r', '$1', 3)])
+	store.addEvents(ROOM, [message('$1', 1)])
+	assertRedacted(storedEvents(store)['$1'], '$r')
+
+def test_redactionInSameBatch():
+	store = EventStore(':memory:')
+	store.addEvents(ROOM, [message('$1', 1), redaction('$r', '$1', 2)])
+	assertRedacted(storedEvents(store)['$1'], '$r')
+	# Adding the event again doesn't bring its content back
+	store.addEvents(ROOM, [message('$1', 1)])
+	assertRedacted(storedEvents(store)['$1'], '$r')
+
+def test_existingRedactionsApplied(tmp_path):
+	path = str(tmp_path / 'events.db')
+	connection = sqlite3.connect(path)
+	connection.execute('CREATE TABLE events (event_id TEXT PRIMARY KEY, room_id TEXT NOT NULL, origin_server_ts INTEGER NOT NULL, event TEXT NOT NULL)')
+	for event in [message('$1', 1), redaction('$r', '$1', 2)]:
+		connection.execute('INSERT INTO events VALUES (?, ?, ?, ?)', (event['event_id'], ROOM, event['origin_server_ts'], json.dumps(event)))
+	connection.commit()
+	connection.close()
+
+	store = EventStore(path)
+	assertRedacted(storedEvents(store)['$1'], '$r')
+	store.close()
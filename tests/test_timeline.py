@@ -0,0 +1,80 @@
+"""
+Checks Timeline against a plain sorted list.
+"""
+
+import random
+
+import pytest
+
+from nutmeg.timeline import Timeline
+
+def makeTimeline(blockSize:int) -> Timeline:
+	timeline = Timeline()
+	# Small blocks, so splitting is exercised
+	timeline.blockSize = blockSize
+	return(timeline)
+
+def test_addReturnsSortedPosition():
+	generator = random.Random(1)
+	timeline = makeTimeline(4)
+	expected = []
+	for i in range(300):
+		key = (generator.randrange(1000), '$%d' % i)
+		position = timeline.add(key, key)
+		expected.append(key)
+		expected.sort()
+		assert expected[position] == key
+	assert list(timeline) == expected
+	assert list(reversed(timeline)) == expected[::-1]
+	assert [timeline[i] for i in range(len(timeline))] == expected
+	assert timeline[-1] == expected[-1]
+
+def test_newestAppends():
+	timeline = makeTimeline(4)
+	for i in range(50):
+		assert timeline.add((i, ''), i) == i
+	assert list(timeline) == list(range(50))
+
+def test_mergeReturnsLowestPosition():
+	generator = random.Random(2)
+	timeline = makeTimeline(4)
+	expected = []
+	for _ in range(20):
+		keys = [(generator.randrange(1000), '$%d' % generator.randrange(10**6)) for _ in range(generator.randrange(15))]
+		run = [(key, key) for key in keys]
+		before = list(expected)
+		lowest = timeline.merge(run)
+		expected = sorted(expected + keys)
+		assert list(timeline) == expected
+		# Everything before the lowest position is unmoved
+		assert expected[:lowest] == before[:lowest]
+		if not run: assert lowest == len(timeline)
+
+def test_removeAndPosition():
+	generator = random.Random(3)
+	timeline = makeTimeline(4)
+	keys = [(generator.randrange(100), '$%d' % i) for i in range(200)]
+	for key in keys:
+		timeline.add(key, key)
+	expected = sorted(keys)
+	for key in generator.sample(keys, len(keys)):
+		assert timeline.position(key) == expected.index(key)
+		assert timeline.remove(key) == expected.index(key)
+		expected.remove(key)
+		assert list(timeline) == expected
+	assert len(timeline) == 0
+
+def test_removeMissing():
+	timeline = makeTimeline(4)
+	timeline.add((1, '$a'), 'a')
+	with pytest.raises(KeyError):
+		timeline.remove((1, '$b'))
+
+def test_slice():
+	timeline = makeTimeline(4)
+	for i in range(40):
+		timeline.add((i, ''), i)
+	assert timeline.slice(5, 23) == list(range(5, 23))
+	assert timeline.slice(-3, 2) == [0, 1]
+	assert timeline.slice(38, 100) == [38, 39]
+	assert timeline.slice(10, 10) == []